@@ -1,6 +1,8 @@
 from website import create_app
 
-app = create_app()
+# Workers of the process pool import this module as __mp_main__, they must not start the app
+if __name__ != '__mp_main__':
+    app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
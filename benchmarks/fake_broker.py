@@ -0,0 +1,277 @@
+# In-process fake of the Tinkoff Invest API for the benchmarks
+
+import asyncio
+import dataclasses
+import datetime
+import threading
+import time
+import types
+import typing as tp
+import zlib
+
+import numpy as np
+import tinkoff.invest as inv
+from grpc import StatusCode
+
+from library.candle_fetcher import MAX_REQUEST_PERIOD
+from library.candles import SECONDS_PER_DAY, to_timestamp
+
+
+###################################################################################
+# Fake broker
+###################################################################################
+
+
+# Period of one candle of the interval, seconds
+CANDLE_PERIOD = {
+    inv.CandleInterval.CANDLE_INTERVAL_1_MIN: 60,
+    inv.CandleInterval.CANDLE_INTERVAL_5_MIN: 5 * 60,
+    inv.CandleInterval.CANDLE_INTERVAL_15_MIN: 15 * 60,
+    inv.CandleInterval.CANDLE_INTERVAL_HOUR: 60 * 60,
+    inv.CandleInterval.CANDLE_INTERVAL_DAY: SECONDS_PER_DAY,
+    inv.CandleInterval.CANDLE_INTERVAL_WEEK: 7 * SECONDS_PER_DAY,
+    inv.CandleInterval.CANDLE_INTERVAL_MONTH: 30 * SECONDS_PER_DAY,
+}
+
+SECTORS = ["it", "energy", "financial", "materials", "consumer", "telecom", "utilities", "health_care"]
+
+
+@dataclasses.dataclass
+class FakeBrokerConfig:
+    n_shares: int = 2000
+    n_positions: int = 20
+    n_operations: int = 50
+    # Seconds every request takes
+    latency: float = 0.0
+    # Requests of every method per rate_limit_window seconds, RESOURCE_EXHAUSTED with ratelimit_reset when exceeded
+    rate_limit: int | None = None
+    rate_limit_window: float = 60.0
+    seed: int = 0
+
+
+def to_quotation(value: float) -> inv.Quotation:
+    units = int(value)
+    return inv.Quotation(units=units, nano=int(round((value - units) * 1e9)))
+
+
+def get_price(figi: str, timestamp: int) -> float:
+    """
+    Deterministic price of figi at timestamp, so overlapping requests return the same candles
+    """
+    phase = zlib.crc32(figi.encode()) % 1000
+    return 100 + phase / 10 + 20 * np.sin((timestamp / SECONDS_PER_DAY + phase) / 30)
+
+
+class FakeBroker:
+    """
+    In-process stand-in for the Tinkoff Invest API: shares, positions, operations,
+    last prices and candles generated from the config, with latency, rate limits
+    and the "maximum request period exceeded" error of GetCandles
+    """
+
+    def __init__(self, config: FakeBrokerConfig | None = None):
+        self.config = config or FakeBrokerConfig()
+        rng = np.random.default_rng(self.config.seed)
+        self.figis = [f"FAKE{i:08d}" for i in range(self.config.n_shares)]
+        self.shares = [
+            inv.Share(
+                figi=figi,
+                ticker=f"T{i}",
+                name=f"Share {i}",
+                currency="rub",
+                class_code="TQBR",
+                country_of_risk="RU",
+                sector=SECTORS[i % len(SECTORS)],
+                exchange="MOEX",
+                share_type=inv.ShareType.SHARE_TYPE_COMMON,
+                lot=int(rng.choice([1, 10, 100])),
+                otc_flag=False,
+                buy_available_flag=True,
+                sell_available_flag=True,
+                for_qual_investor_flag=False,
+            )
+            for i, figi in enumerate(self.figis)
+        ]
+        self.position_figis = [str(figi) for figi in rng.choice(self.figis, size=min(self.config.n_positions, len(self.figis)), replace=False)]
+        self.balances = {figi: int(rng.integers(1, 1000)) for figi in self.position_figis}
+        self._operation_days = rng.integers(1, 3 * 365, size=self.config.n_operations)
+        self.n_requests: dict[str, int] = {}
+        self.n_rejected: dict[str, int] = {}
+        # method -> (start of the rate limit window, requests in it)
+        self._windows: dict[str, tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    async def request(self, method: str) -> None:
+        """
+        Count the request, apply the rate limit and the latency
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.n_requests[method] = self.n_requests.get(method, 0) + 1
+            if self.config.rate_limit is not None:
+                window_start, n_requests = self._windows.get(method, (now, 0))
+                if now - window_start >= self.config.rate_limit_window:
+                    window_start, n_requests = now, 0
+                if n_requests >= self.config.rate_limit:
+                    self.n_rejected[method] = self.n_rejected.get(method, 0) + 1
+                    ratelimit_reset = self.config.rate_limit_window - (now - window_start)
+                    raise inv.exceptions.AioRequestError(
+                        StatusCode.RESOURCE_EXHAUSTED, "", types.SimpleNamespace(ratelimit_reset=ratelimit_reset, message="rate limit exceeded")
+                    )
+                self._windows[method] = window_start, n_requests + 1
+        if self.config.latency:
+            await asyncio.sleep(self.config.latency)
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.n_requests.clear()
+            self.n_rejected.clear()
+            self._windows.clear()
+
+    def get_candles(self, figi: str, from_: datetime.datetime, to: datetime.datetime, interval: inv.CandleInterval) -> list[inv.HistoricCandle]:
+        if to - from_ > MAX_REQUEST_PERIOD[interval]:
+            raise inv.exceptions.AioRequestError(
+                StatusCode.INVALID_ARGUMENT, "30014", types.SimpleNamespace(ratelimit_reset=0, message="maximum request period exceeded")
+            )
+        period = CANDLE_PERIOD[interval]
+        from_ts, to_ts = to_timestamp(from_), to_timestamp(to)
+        candles = []
+        for timestamp in range(-(-from_ts // period) * period, to_ts, period):
+            close = get_price(figi, timestamp)
+            candles.append(inv.HistoricCandle(
+                open=to_quotation(close * 0.99),
+                high=to_quotation(close * 1.01),
+                low=to_quotation(close * 0.98),
+                close=to_quotation(close),
+                volume=1000,
+                time=datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc),
+                is_complete=timestamp + period <= time.time(),
+            ))
+        return candles
+
+    def get_operations(self, from_: datetime.datetime) -> list[inv.Operation]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        operations = []
+        for i, days_ago in enumerate(self._operation_days):
+            date = now - datetime.timedelta(days=int(days_ago))
+            if date < from_.replace(tzinfo=datetime.timezone.utc):
+                continue
+            operations.append(inv.Operation(
+                figi=self.position_figis[i % len(self.position_figis)],
+                operation_type=inv.OperationType.OPERATION_TYPE_BUY if i % 3 else inv.OperationType.OPERATION_TYPE_SELL,
+                date=date,
+                quantity=1,
+                quantity_rest=0,
+                state=inv.OperationState.OPERATION_STATE_EXECUTED,
+            ))
+        return operations
+
+
+###################################################################################
+# Fake services
+###################################################################################
+
+
+class FakeUsersService:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    async def get_accounts(self) -> inv.GetAccountsResponse:
+        await self.broker.request("get_accounts")
+        return inv.GetAccountsResponse(accounts=[inv.Account(
+            id="fake-account",
+            type=inv.AccountType.ACCOUNT_TYPE_TINKOFF,
+            name="Fake",
+            status=inv.AccountStatus.ACCOUNT_STATUS_OPEN,
+        )])
+
+
+class FakeInstrumentsService:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    async def shares(self) -> inv.SharesResponse:
+        await self.broker.request("shares")
+        return inv.SharesResponse(instruments=self.broker.shares)
+
+
+class FakeOperationsService:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    async def get_positions(self, account_id: str) -> inv.PositionsResponse:
+        await self.broker.request("get_positions")
+        return inv.PositionsResponse(securities=[
+            inv.PositionsSecurities(figi=figi, balance=balance, instrument_type="share")
+            for figi, balance in self.broker.balances.items()
+        ])
+
+    async def get_operations(self, account_id: str, from_: datetime.datetime, to: datetime.datetime, state: inv.OperationState) -> inv.OperationsResponse:
+        await self.broker.request("get_operations")
+        return inv.OperationsResponse(operations=self.broker.get_operations(from_))
+
+
+class FakeMarketDataService:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    async def get_candles(self, figi: str, from_: datetime.datetime, to: datetime.datetime, interval: inv.CandleInterval) -> inv.GetCandlesResponse:
+        await self.broker.request("get_candles")
+        return inv.GetCandlesResponse(candles=self.broker.get_candles(figi, from_, to, interval))
+
+    async def get_last_prices(self, figi: list[str]) -> inv.GetLastPricesResponse:
+        await self.broker.request("get_last_prices")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return inv.GetLastPricesResponse(last_prices=[
+            inv.LastPrice(figi=f, price=to_quotation(get_price(f, int(now.timestamp()))), time=now) for f in figi
+        ])
+
+
+class FakeMarketDataStreamService:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+
+    async def market_data_stream(self, requests: tp.AsyncIterator[inv.MarketDataRequest]) -> tp.AsyncIterator[inv.MarketDataResponse]:
+        """
+        Confirmation of every subscription and one last price of every subscribed figi
+        """
+        async for request in requests:
+            subscription = request.subscribe_last_price_request
+            yield inv.MarketDataResponse(subscribe_last_price_response=inv.SubscribeLastPriceResponse(last_price_subscriptions=[
+                inv.LastPriceSubscription(figi=instrument.figi, subscription_status=inv.SubscriptionStatus.SUBSCRIPTION_STATUS_SUCCESS)
+                for instrument in subscription.instruments
+            ]))
+            if subscription.subscription_action != inv.SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE:
+                continue
+            now = datetime.datetime.now(datetime.timezone.utc)
+            for instrument in subscription.instruments:
+                price = to_quotation(get_price(instrument.figi, int(now.timestamp())))
+                yield inv.MarketDataResponse(last_price=inv.LastPrice(figi=instrument.figi, price=price, time=now))
+
+
+class FakeServices:
+    """
+    Subset of inv.clients.AsyncServices used by the library
+    """
+
+    def __init__(self, broker: FakeBroker):
+        self.users = FakeUsersService(broker)
+        self.instruments = FakeInstrumentsService(broker)
+        self.operations = FakeOperationsService(broker)
+        self.market_data = FakeMarketDataService(broker)
+        self.market_data_stream = FakeMarketDataStreamService(broker)
+
+
+class FakeClient:
+    """
+    Replacement of inv.AsyncClient, e.g. ClientPool(client_factory=lambda token: FakeClient(broker))
+    """
+
+    def __init__(self, broker: FakeBroker):
+        self.services = FakeServices(broker)
+
+    async def __aenter__(self) -> FakeServices:
+        return self.services
+
+    async def __aexit__(self, *args) -> None:
+        pass
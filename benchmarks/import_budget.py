@@ -0,0 +1,118 @@
+# Import-time budget of the web app and the screener CLI, run from the repository root: python -m benchmarks.import_budget
+# Exits with 1 if a target is over its budget or imports a module it must not, so it can gate CI.
+# Budgets are relative to a baseline import timed on the same machine, so they hold on slow and fast machines alike
+
+import argparse
+import dataclasses
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+# Modules of the analytics and broker stacks
+HEAVY_MODULES = ("numpy", "pandas", "plotly", "colour", "grpc", "tinkoff")
+
+
+@dataclasses.dataclass
+class Target:
+    name: str
+    # Code timed in a fresh interpreter
+    code: str
+    # Import the code builds on, timed the same way
+    baseline: str
+    # Median of the code relative to the median of the baseline
+    budget: float
+    # Top-level modules that must not be imported by code
+    forbidden: tuple[str, ...] = ()
+
+
+TARGETS = [
+    # Worker start: the app serves login and sign-up without the analytics and broker stacks
+    Target("web_app", "import website; website.create_app(instance_path=INSTANCE_PATH)", baseline="import flask", budget=3.5, forbidden=HEAVY_MODULES),
+    # The screener needs numpy, pandas and tinkoff.invest, but not the plotting stack
+    Target("screener_cli", "import underrepresented_shares.get_underrepresented_shares", baseline="import pandas", budget=4.0, forbidden=("plotly", "colour")),
+]
+
+CHILD = """
+import sys, time, json
+INSTANCE_PATH = {instance_path!r}
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": sorted({{name.split(".")[0] for name in sys.modules}})}}))
+"""
+
+
+###################################################################################
+# Measurement
+###################################################################################
+
+
+def run_code(code: str, instance_path: str) -> tuple[float, list[str]]:
+    """
+    Seconds of code in a fresh interpreter and the top-level modules it imported
+    """
+    child = CHILD.format(instance_path=instance_path, code=code)
+    output = subprocess.run([sys.executable, "-c", child], check=True, capture_output=True, text=True, env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    return result["seconds"], result["modules"]
+
+
+def time_code(code: str, repeat: int, instance_path: str) -> tuple[float, set[str]]:
+    """
+    Median seconds of code over repeat runs and the top-level modules imported by any of them
+    """
+    seconds = []
+    modules = set()
+    for _ in range(repeat):
+        run_seconds, run_modules = run_code(code, instance_path)
+        seconds.append(run_seconds)
+        modules.update(run_modules)
+    return statistics.median(seconds), modules
+
+
+def check_target(target: Target, repeat: int, instance_path: str, budget_scale: float) -> bool:
+    baseline, _ = time_code(target.baseline, repeat, instance_path)
+    median, modules = time_code(target.code, repeat, instance_path)
+    budget = target.budget * budget_scale
+    ratio = median / baseline
+    imported = [name for name in target.forbidden if name in modules]
+    ok = ratio <= budget and not imported
+    status = "ok" if ok else "FAILED"
+    print(
+        f"{target.name:<16} median {median * 1000:7.1f} ms  {ratio:4.1f}x {target.baseline!r} ({baseline * 1000:.1f} ms)  "
+        f"budget {budget:4.1f}x  forbidden imported: {', '.join(imported) or '-'}  {status}"
+    )
+    return ok
+
+
+###################################################################################
+# Main
+###################################################################################
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Import-time budget of the web app and the screener CLI")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", default=None, help=f"Check only these targets ({', '.join(target.name for target in TARGETS)})")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="Multiplier of the budgets")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    # The database of the app is created in a temporary instance folder
+    instance_path = tempfile.mkdtemp(prefix="import-budget-")
+    results = [
+        check_target(target, args.repeat, instance_path, args.budget_scale)
+        for target in TARGETS
+        if args.only is None or target.name in args.only
+    ]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+# Offline benchmarks on a fake broker, run from the repository root: python -m benchmarks.run --help
+
+import argparse
+import asyncio
+import dataclasses
+import datetime
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import typing as tp
+
+import tinkoff.invest as inv
+
+sys.path.append('.')
+
+import library.utils as utils
+import visualization.visualize as visualize
+from benchmarks.fake_broker import FakeBroker, FakeBrokerConfig, FakeClient, FakeServices
+from library.cache import MARKET_DATA_SCOPE, TieredCache
+from library.candle_fetcher import CandleFetcher
+from library.candle_store import CandleStore
+from library.metrics import registry
+from library.runtime import ClientPool
+from library.universe import ShareUniverse
+from underrepresented_shares.get_underrepresented_shares import get_underrepresented_shares
+
+TOKEN = "fake-token"
+ACCOUNT_ID = "fake-account"
+SCREENER_CONFIG = {
+    "filters": [
+        {"column": "currency", "op": "==", "value": "rub"},
+        {"column": "buy_available_flag", "op": "==", "value": True},
+        {"column": "lot_price", "op": "<=", "value": 3000000.0},
+    ],
+    "sort_by": ["lot_price"],
+}
+
+
+###################################################################################
+# Measurement
+###################################################################################
+
+
+@dataclasses.dataclass
+class Result:
+    name: str
+    params: dict
+    seconds: list[float]
+    # Counters of the last run (requests, candles, bytes...)
+    info: dict = dataclasses.field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "params": self.params, "min": min(self.seconds), "median": statistics.median(self.seconds), "info": self.info}
+
+
+def reset_state(client_rpm: float) -> None:
+    """
+    Fresh caches and market data singletons in a new working directory, so the next run is cold.
+    The last price table is kept, the last price stream writes into it
+    """
+    os.chdir(tempfile.mkdtemp(prefix="benchmark-"))
+    utils.cache = TieredCache(columnar={"universe": ShareUniverse})
+    utils.candle_store = CandleStore()
+    utils.candle_fetcher = CandleFetcher(requests_per_minute=client_rpm, backoff=0.01)
+    utils.price_matrices.clear()
+    utils.process_pool.clear()
+
+
+async def measure(
+    name: str,
+    params: dict,
+    function: tp.Callable[[], tp.Awaitable[dict | None]],
+    repeat: int,
+    setup: tp.Callable[[], None] | None = None,
+) -> Result:
+    """
+    Time function repeat times, setup (not timed) runs before every call
+    """
+    seconds = []
+    info = {}
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        info = await function() or {}
+        seconds.append(time.perf_counter() - start)
+    result = Result(name, params, seconds, info)
+    print(format_result(result), flush=True)
+    return result
+
+
+def format_result(result: Result) -> str:
+    params = " ".join(f"{key}={value}" for key, value in result.params.items())
+    info = " ".join(f"{key}={value}" for key, value in result.info.items())
+    return f"{result.name:<28} {params:<32} min {min(result.seconds) * 1000:9.1f} ms  median {statistics.median(result.seconds) * 1000:9.1f} ms  {info}"
+
+
+###################################################################################
+# Benchmarks
+###################################################################################
+
+
+async def bench_candle_fetch(args: argparse.Namespace, n_figis: int, n_days: int) -> list[Result]:
+    """
+    Cold fetch of daily candles: request windows, concurrency and retries on rate limits
+    """
+    broker = FakeBroker(get_broker_config(args))
+    services = FakeServices(broker)
+    figis = broker.figis[:n_figis]
+    to = datetime.datetime.utcnow()
+    from_ = to - datetime.timedelta(days=n_days)
+
+    async def fetch() -> dict:
+        fetcher = CandleFetcher(requests_per_minute=args.client_rpm, backoff=0.01)
+        start = time.perf_counter()
+        results = await asyncio.gather(*[fetcher.fetch(services, figi, from_, to, inv.CandleInterval.CANDLE_INTERVAL_DAY) for figi in figis])
+        n_candles = sum(map(len, results))
+        return {
+            "candles_per_s": round(n_candles / (time.perf_counter() - start)),
+            "requests": broker.n_requests.get("get_candles", 0),
+            "rate_limited": broker.n_rejected.get("get_candles", 0),
+        }
+
+    result = await measure("candle_fetch", {"figis": n_figis, "days": n_days}, fetch, args.repeat, setup=broker.reset_counters)
+    return [result]
+
+
+async def bench_candle_store(args: argparse.Namespace, n_figis: int, n_days: int) -> list[Result]:
+    """
+    get_candles through the candle store: cold (fetch and write), warm in memory and warm from disk
+    """
+    broker = FakeBroker(get_broker_config(args))
+    services = FakeServices(broker)
+    figis = broker.figis[:n_figis]
+    params = {"figis": n_figis, "days": n_days}
+
+    async def get_candles() -> dict:
+        broker.reset_counters()
+        await utils.get_candles(services, figis, n_days)()
+        return {"requests": broker.n_requests.get("get_candles", 0)}
+
+    results = [await measure("candle_store_miss", params, get_candles, args.repeat, setup=lambda: reset_state(args.client_rpm))]
+    results.append(await measure("candle_store_hit_memory", params, get_candles, args.repeat))
+
+    def reopen() -> None:
+        utils.candle_store = CandleStore()
+
+    results.append(await measure("candle_store_hit_disk", params, get_candles, args.repeat, setup=reopen))
+    return results
+
+
+async def bench_cache(args: argparse.Namespace) -> list[Result]:
+    """
+    Share universe through the tiered cache: miss, memory hit and disk (memory-mapped) hit
+    """
+    services = FakeServices(FakeBroker(get_broker_config(args)))
+    params = {"shares": args.n_shares}
+
+    async def load() -> dict:
+        universe = await utils.load_from_cache("universe", utils.get_share_universe(services), False, scope=MARKET_DATA_SCOPE)
+        return {"rows": len(universe)}
+
+    results = [await measure("universe_miss", params, load, args.repeat, setup=lambda: reset_state(args.client_rpm))]
+    results.append(await measure("universe_hit_memory", params, load, args.repeat))
+
+    def clear_memory() -> None:
+        utils.cache = TieredCache(columnar={"universe": ShareUniverse})
+
+    results.append(await measure("universe_hit_disk", params, load, args.repeat, setup=clear_memory))
+    return results
+
+
+async def bench_portfolio(args: argparse.Namespace, n_positions: int, n_days: int) -> list[Result]:
+    """
+    End-to-end portfolio page as in the web app (pooled client, last price stream):
+    JSON data of the page, cold and warm
+    """
+    broker = FakeBroker(get_broker_config(args, n_positions=n_positions))
+    client_pool = ClientPool(client_factory=lambda token: FakeClient(broker))
+    params = {"positions": n_positions, "days": n_days}
+
+    async def get_data() -> dict:
+        broker.reset_counters()
+        data = await visualize.get_portfolio_data_async(TOKEN, ACCOUNT_ID, n_days, client_pool)
+        return {"requests": sum(broker.n_requests.values()), "json_bytes": len(json.dumps(data))}
+
+    try:
+        results = [await measure("portfolio_data_cold", params, get_data, args.repeat, setup=lambda: reset_state(args.client_rpm))]
+        results.append(await measure("portfolio_data_warm", params, get_data, args.repeat))
+    finally:
+        await utils.last_price_stream.stop()
+        await client_pool.close()
+    return results
+
+
+async def bench_screener(args: argparse.Namespace) -> list[Result]:
+    """
+    Underrepresented shares screener over the whole universe, cold and warm
+    """
+    broker = FakeBroker(get_broker_config(args))
+    services = FakeServices(broker)
+    params = {"shares": args.n_shares}
+
+    async def screen() -> dict:
+        broker.reset_counters()
+        df = await get_underrepresented_shares(services, TOKEN, ACCOUNT_ID, SCREENER_CONFIG, force_update=False)
+        return {"rows": len(df), "requests": sum(broker.n_requests.values())}
+
+    results = [await measure("screener_cold", params, screen, args.repeat, setup=lambda: reset_state(args.client_rpm))]
+    results.append(await measure("screener_warm", params, screen, args.repeat))
+    return results
+
+
+###################################################################################
+# Main
+###################################################################################
+
+
+def get_broker_config(args: argparse.Namespace, **kwargs) -> FakeBrokerConfig:
+    return FakeBrokerConfig(
+        n_shares=args.n_shares,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        rate_limit_window=args.rate_limit_window,
+        **kwargs,
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmarks on a fake broker")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50], help="Portfolio sizes (positions / figis)")
+    parser.add_argument("--horizons", type=int, nargs="+", default=[30, 365, 1825], help="Horizons in days")
+    parser.add_argument("--n-shares", type=int, default=2000, help="Shares in the universe")
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds of every fake request")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Fake requests per window of every method")
+    parser.add_argument("--rate-limit-window", type=float, default=1.0, help="Seconds of the fake rate limit window")
+    parser.add_argument("--client-rpm", type=float, default=600, help="Client-side requests per minute of the candle fetcher")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", default=None, help="Run only these benchmarks (candle_fetch, candle_store, cache, portfolio, screener)")
+    parser.add_argument("--output", default=None, help="Write results to this JSON file")
+    parser.add_argument("--metrics", action="store_true", help="Print the collected metrics (stages, requests, cache)")
+    return parser.parse_args()
+
+
+async def main() -> None:
+    args = parse_args()
+    if args.output is not None:
+        args.output = os.path.abspath(args.output)
+    selected = lambda name: args.only is None or name in args.only
+    results = []
+    for size in args.sizes:
+        for n_days in args.horizons:
+            if selected("candle_fetch"):
+                results += await bench_candle_fetch(args, size, n_days)
+            if selected("candle_store"):
+                results += await bench_candle_store(args, size, n_days)
+            if selected("portfolio"):
+                results += await bench_portfolio(args, size, n_days)
+    if selected("cache"):
+        results += await bench_cache(args)
+    if selected("screener"):
+        results += await bench_screener(args)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([result.to_dict() for result in results], f, indent=2)
+    if args.metrics:
+        print(registry.render())
+    utils.process_pool.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,320 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import os
+import pickle
+import threading
+import time
+import typing as tp
+from pathlib import Path
+
+from cachetools import LRUCache
+
+import numpy as np
+
+from library.columnar import read_columns, write_columns
+from library.files import atomic_write
+from library.metrics import CACHE_BYTES_STORED, CACHE_REQUESTS
+
+try:
+    import fcntl
+except ImportError:  # Windows: no locking between processes
+    fcntl = None
+
+
+###################################################################################
+# Time to live
+###################################################################################
+
+
+# Seconds an entry of the given kind stays fresh
+CACHE_TTL: dict[str, float] = {
+    # Accounts of a token, None for an incorrect token
+    "accounts": 5 * 60,
+    "universe": 24 * 60 * 60,
+    "positions": 5 * 60,
+    "operations": 5 * 60,
+    "last_prices": 10,
+    "candles": 60 * 60,
+}
+DEFAULT_TTL = 60.0
+
+# Scope of market data (instruments, prices, candles) shared by all users
+MARKET_DATA_SCOPE = "market_data"
+
+
+def make_key(kind: str, scope: str = "", params: tuple = ()) -> str:
+    """
+    Cache key of (scope, kind, params).
+    The scope (token / account) is hashed, so tokens never reach the disk in plain text
+    """
+    digest = hashlib.sha256(repr((scope, kind, params)).encode()).hexdigest()[:32]
+    return f"{kind}_{digest}"
+
+
+###################################################################################
+# Locks
+###################################################################################
+
+
+def _is_same_file(fd: int, path: Path) -> bool:
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+class KeyLock:
+    """
+    Lock per key for coroutines of any thread and event loop of the process.
+    With a directory, the key is also locked between processes (flock on a lock file)
+    """
+
+    def __init__(self, directory: str | Path | None = None):
+        self.directory = None if directory is None else Path(directory)
+        # key -> future set when the holder releases the key
+        self._held: dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    async def _acquire_local(self, key: str) -> None:
+        while True:
+            with self._lock:
+                released = self._held.get(key)
+                if released is None:
+                    self._held[key] = concurrent.futures.Future()
+                    return
+            # shield: cancelling the waiter must not mark the key as released
+            await asyncio.shield(asyncio.wrap_future(released))
+
+    def _release_local(self, key: str) -> None:
+        with self._lock:
+            self._held.pop(key).set_result(None)
+
+    async def _acquire_file(self, key: str) -> int:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / (key + ".lock")
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                future = asyncio.get_running_loop().run_in_executor(None, fcntl.flock, fd, fcntl.LOCK_EX)
+                try:
+                    await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    future.add_done_callback(lambda _: os.close(fd))
+                    raise
+            # prune could have removed the file while we waited, its lock no longer excludes anyone
+            if _is_same_file(fd, path):
+                return fd
+            os.close(fd)
+
+    def prune(self) -> int:
+        """
+        Remove lock files no process holds, so the directory does not keep a file for every key ever locked.
+        Returns the number of removed files
+        """
+        if self.directory is None or fcntl is None:
+            return 0
+        n_removed = 0
+        for path in self.directory.glob("*.lock"):
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if _is_same_file(fd, path):
+                    path.unlink()
+                    n_removed += 1
+            except BlockingIOError:
+                pass
+            finally:
+                os.close(fd)
+        return n_removed
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key: str) -> tp.AsyncIterator[None]:
+        await self._acquire_local(key)
+        try:
+            if self.directory is None or fcntl is None:
+                yield
+                return
+            fd = await self._acquire_file(key)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+        finally:
+            self._release_local(key)
+
+
+###################################################################################
+# Tiered cache
+###################################################################################
+
+
+class Columnar(tp.Protocol):
+    """
+    Value stored on disk as memory-mapped columns instead of a pickle
+    """
+
+    def to_columns(self) -> dict[str, np.ndarray]: ...
+
+    @classmethod
+    def from_columns(cls, columns: dict[str, np.ndarray]) -> "Columnar": ...
+
+
+
+class TieredCache:
+    """
+    In-process LRU tier in front of a disk tier.
+    Values are pickled, except kinds registered as columnar: they are loaded lazily from memory-mapped columns.
+    Every kind of data has its own TTL, both tiers are size-bounded and expired files are removed from the disk.
+    Concurrent loads of one key (from threads or processes) run a single fetch
+    """
+
+    def __init__(
+        self,
+        directory: str | Path = "cache",
+        ttl: dict[str, float] | None = None,
+        max_memory_items: int = 256,
+        max_disk_bytes: int = 512 * 1024 * 1024,
+        columnar: dict[str, type[Columnar]] | None = None,
+        evict_interval: int = 64,
+    ):
+        self.directory = Path(directory)
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        # kind -> type of its values
+        self.columnar = columnar or {}
+        self.max_disk_bytes = max_disk_bytes
+        # Writes between scans of the disk tier
+        self.evict_interval = evict_interval
+        self._n_writes = 0
+        self._memory: LRUCache = LRUCache(maxsize=max_memory_items)
+        self._key_lock = KeyLock(self.directory / ".locks")
+
+    def get_ttl(self, kind: str) -> float:
+        return self.ttl.get(kind, DEFAULT_TTL)
+
+    def _is_fresh(self, kind: str, created_at: float) -> bool:
+        return time.time() - created_at < self.get_ttl(kind)
+
+    def _get_path(self, kind: str, key: str) -> Path:
+        return self.directory / kind / (key + (".cols" if kind in self.columnar else ".pickle"))
+
+    def _read_disk(self, kind: str, path: Path) -> tuple[float, tp.Any] | None:
+        try:
+            if kind in self.columnar:
+                columns, meta = read_columns(path)
+                entry = meta["created_at"], self.columnar[kind].from_columns(columns)
+            else:
+                with open(path, "rb") as f:
+                    entry = pickle.load(f)
+        except (FileNotFoundError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        # Mark as recently used for the eviction, mtime stays the time of the write
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path, ns=(time.time_ns(), path.stat().st_mtime_ns))
+        return entry
+
+    def _write_disk(self, kind: str, path: Path, entry: tuple[float, tp.Any]) -> None:
+        created_at, value = entry
+        if kind in self.columnar:
+            write_columns(path, value.to_columns(), {"created_at": created_at})
+        else:
+            atomic_write(path, lambda f: pickle.dump(entry, f))
+        CACHE_BYTES_STORED.inc(path.stat().st_size, kind=kind)
+        # Scanning the directory costs O(files), it is done once in evict_interval writes
+        self._n_writes += 1
+        if self._n_writes % self.evict_interval == 0:
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """
+        Remove expired files, then least recently used ones until the disk tier fits into max_disk_bytes,
+        and the lock files of keys nobody loads
+        """
+        now = time.time()
+        files = []
+        for path in [*self.directory.glob("*/*.pickle"), *self.directory.glob("*/*.cols")]:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            # Files are in the directory of their kind, mtime is the time of the write
+            if now - stat.st_mtime >= self.get_ttl(path.parent.name):
+                path.unlink(missing_ok=True)
+                continue
+            files.append((stat.st_atime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.max_disk_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+        self._key_lock.prune()
+
+    def get(self, kind: str, scope: str = "", params: tuple = ()) -> tp.Any | None:
+        """
+        Fresh cached value or None
+        """
+        entry, source = self._get_entry(kind, make_key(kind, scope, params))
+        CACHE_REQUESTS.inc(kind=kind, result=source)
+        return None if entry is None else entry[1]
+
+    def _get_entry(self, kind: str, key: str) -> tuple[tuple[float, tp.Any] | None, str]:
+        """
+        Fresh entry and the tier it was found in ("memory", "disk" or "miss")
+        """
+        entry = self._memory.get(key)
+        if entry is not None and self._is_fresh(kind, entry[0]):
+            return entry, "memory"
+        entry = self._read_disk(kind, self._get_path(kind, key))
+        if entry is not None and self._is_fresh(kind, entry[0]):
+            self._memory[key] = entry
+            return entry, "disk"
+        return None, "miss"
+
+    def put(self, kind: str, value: tp.Any, scope: str = "", params: tuple = ()) -> None:
+        key = make_key(kind, scope, params)
+        entry = (time.time(), value)
+        self._memory[key] = entry
+        self._write_disk(kind, self._get_path(kind, key), entry)
+
+    def invalidate(self, kind: str, scope: str = "", params: tuple = ()) -> None:
+        key = make_key(kind, scope, params)
+        self._memory.pop(key, None)
+        self._get_path(kind, key).unlink(missing_ok=True)
+
+    async def get_or_load(
+        self,
+        kind: str,
+        function: tp.Callable[..., tp.Awaitable],
+        scope: str = "",
+        params: tuple = (),
+        force_update: bool = False,
+    ):
+        """
+        Returns cached value if it is fresh, otherwise awaits function and caches its result.
+        Callers that miss the same key wait for the first one and get its result from the cache
+        """
+        key = make_key(kind, scope, params)
+        if not force_update:
+            entry, source = self._get_entry(kind, key)
+            if entry is not None:
+                CACHE_REQUESTS.inc(kind=kind, result=source)
+                return entry[1]
+        requested_at = time.time()
+        async with self._key_lock.lock(key):
+            # Another caller could have loaded it while we waited for the lock
+            entry, _ = self._get_entry(kind, key)
+            if entry is not None and (not force_update or entry[0] >= requested_at):
+                CACHE_REQUESTS.inc(kind=kind, result="coalesced")
+                return entry[1]
+            CACHE_REQUESTS.inc(kind=kind, result="miss")
+            result = await function()
+            self.put(kind, result, scope, params)
+        return result
@@ -0,0 +1,163 @@
+import asyncio
+import datetime
+import threading
+import time
+import weakref
+
+import tinkoff.invest as inv
+from grpc import StatusCode
+
+from library.metrics import BROKER_RETRIES
+
+
+###################################################################################
+# Request windows
+###################################################################################
+
+
+# Maximum period of one GetCandles request for the given interval
+MAX_REQUEST_PERIOD: dict[inv.CandleInterval, datetime.timedelta] = {
+    inv.CandleInterval.CANDLE_INTERVAL_1_MIN: datetime.timedelta(days=1),
+    inv.CandleInterval.CANDLE_INTERVAL_2_MIN: datetime.timedelta(days=1),
+    inv.CandleInterval.CANDLE_INTERVAL_3_MIN: datetime.timedelta(days=1),
+    inv.CandleInterval.CANDLE_INTERVAL_5_MIN: datetime.timedelta(days=1),
+    inv.CandleInterval.CANDLE_INTERVAL_10_MIN: datetime.timedelta(days=1),
+    inv.CandleInterval.CANDLE_INTERVAL_15_MIN: datetime.timedelta(days=1),
+    inv.CandleInterval.CANDLE_INTERVAL_30_MIN: datetime.timedelta(days=2),
+    inv.CandleInterval.CANDLE_INTERVAL_HOUR: datetime.timedelta(weeks=1),
+    inv.CandleInterval.CANDLE_INTERVAL_2_HOUR: datetime.timedelta(days=30),
+    inv.CandleInterval.CANDLE_INTERVAL_4_HOUR: datetime.timedelta(days=30),
+    inv.CandleInterval.CANDLE_INTERVAL_DAY: datetime.timedelta(days=365),
+    inv.CandleInterval.CANDLE_INTERVAL_WEEK: datetime.timedelta(days=2 * 365),
+    inv.CandleInterval.CANDLE_INTERVAL_MONTH: datetime.timedelta(days=10 * 365),
+}
+
+
+def plan_windows(
+    from_: datetime.datetime, to: datetime.datetime, interval: inv.CandleInterval
+) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    """
+    Split [from_, to) into consecutive windows allowed for one request of the interval
+    """
+    period = MAX_REQUEST_PERIOD[interval]
+    windows = []
+    while from_ < to:
+        window_to = min(from_ + period, to)
+        windows.append((from_, window_to))
+        from_ = window_to
+    return windows
+
+
+###################################################################################
+# Rate limiting
+###################################################################################
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all event loops of the process.
+    A full bucket (capacity, a tenth of the minute quota by default) plus the refill of a minute
+    is rate_per_minute, so no 60-second window gets more requests than the quota
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.capacity = rate_per_minute / 10 if capacity is None else capacity
+        if not 1 <= self.capacity < rate_per_minute:
+            raise ValueError(f"Capacity {self.capacity} must be at least 1 and less than rate_per_minute {rate_per_minute}")
+        self.rate = (rate_per_minute - self.capacity) / 60
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _try_take(self) -> float:
+        """
+        Takes a token and returns 0 or returns the number of seconds to wait for it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    async def acquire(self) -> None:
+        while (delay := self._try_take()) > 0:
+            await asyncio.sleep(delay)
+
+
+###################################################################################
+# Candle fetcher
+###################################################################################
+
+
+class CandleFetcher:
+    """
+    Fetches candles in planned windows with bounded concurrency, a rate limit
+    and retries with exponential backoff on RESOURCE_EXHAUSTED
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        requests_per_minute: float = 600,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(requests_per_minute)
+        # asyncio primitives are bound to one event loop
+        self._semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = weakref.WeakKeyDictionary()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    def _get_retry_delay(self, ex: inv.exceptions.AioRequestError, attempt: int) -> float:
+        ratelimit_reset = getattr(ex.metadata, "ratelimit_reset", None)
+        if ratelimit_reset:
+            return float(ratelimit_reset)
+        return self.backoff * 2**attempt
+
+    async def _fetch_window(
+        self,
+        client: inv.clients.AsyncServices,
+        figi: str,
+        from_: datetime.datetime,
+        to: datetime.datetime,
+        interval: inv.CandleInterval,
+    ) -> list[inv.HistoricCandle]:
+        attempt = 0
+        while True:
+            async with self._get_semaphore():
+                await self.bucket.acquire()
+                try:
+                    return (await client.market_data.get_candles(figi=figi, from_=from_, to=to, interval=interval)).candles
+                except inv.exceptions.AioRequestError as ex:
+                    if ex.code != StatusCode.RESOURCE_EXHAUSTED or attempt >= self.max_retries:
+                        raise
+                    delay = self._get_retry_delay(ex, attempt)
+            attempt += 1
+            BROKER_RETRIES.inc(method="market_data.get_candles")
+            print(f"Rate limit exceeded for {figi}, retry in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def fetch(
+        self,
+        client: inv.clients.AsyncServices,
+        figi: str,
+        from_: datetime.datetime,
+        to: datetime.datetime,
+        interval: inv.CandleInterval,
+    ) -> list[inv.HistoricCandle]:
+        """
+        All candles of figi in [from_, to)
+        """
+        windows = plan_windows(from_, to, interval)
+        results = await asyncio.gather(*[self._fetch_window(client, figi, window_from, window_to, interval) for window_from, window_to in windows])
+        return [candle for candles in results for candle in candles]
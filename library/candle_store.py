@@ -0,0 +1,119 @@
+import datetime
+import time
+import typing as tp
+from pathlib import Path
+
+import tinkoff.invest as inv
+
+from library.cache import KeyLock
+from library.candles import Candles, candles_to_columns, to_timestamp
+from library.columnar import read_columns, write_columns
+from library.metrics import CACHE_BYTES_STORED, CACHE_REQUESTS
+
+
+# Fetches candles of figi in [from_, to)
+FetchCandles = tp.Callable[[str, datetime.datetime, datetime.datetime, inv.CandleInterval], tp.Awaitable[list[inv.HistoricCandle]]]
+
+
+###################################################################################
+# Candle store
+###################################################################################
+
+
+class CandleStore:
+    """
+    Persistent per-FIGI/interval candle store.
+    Every file keeps the candles as memory-mapped columns together with the covered range [start, end),
+    so only the missing head and tail are fetched and any window is answered by slicing.
+    Updates of one figi/interval are serialized between tasks and processes, and files are replaced atomically
+    """
+
+    def __init__(self, directory: str | Path = "cache/candle_store", refresh_interval: float = 60.0):
+        self.directory = Path(directory)
+        # Seconds during which the last (still-forming) candle is not refetched
+        self.refresh_interval = refresh_interval
+        # (figi, interval) -> (file modification time, stored range)
+        self._loaded: dict[tuple[str, inv.CandleInterval], tuple[int, tuple[Candles, int, int, float]]] = {}
+        self._key_lock = KeyLock(self.directory / ".locks")
+
+    def _get_path(self, figi: str, interval: inv.CandleInterval) -> Path:
+        return self.directory / interval.name / (figi + ".cols")
+
+    def load(self, figi: str, interval: inv.CandleInterval) -> tuple[Candles, int, int, float] | None:
+        """
+        (candles, start, end, updated_at) of the stored range or None
+        """
+        key = (figi, interval)
+        path = self._get_path(figi, interval)
+        try:
+            # Another process could have replaced the file
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if key in self._loaded and self._loaded[key][0] == mtime:
+            return self._loaded[key][1]
+        columns, meta = read_columns(path)
+        stored = Candles(**columns), meta["start"], meta["end"], meta["updated_at"]
+        self._loaded[key] = mtime, stored
+        return stored
+
+    def save(self, figi: str, interval: inv.CandleInterval, candles: Candles, start: int, end: int) -> None:
+        path = self._get_path(figi, interval)
+        updated_at = time.time()
+        write_columns(path, candles.to_dict(), {"start": start, "end": end, "updated_at": updated_at})
+        CACHE_BYTES_STORED.inc(path.stat().st_size, kind="candle_store")
+        self._loaded[(figi, interval)] = path.stat().st_mtime_ns, (candles, start, end, updated_at)
+
+    async def get_candles(
+        self,
+        figi: str,
+        interval: inv.CandleInterval,
+        from_: datetime.datetime,
+        to: datetime.datetime,
+        fetch: FetchCandles,
+    ) -> Candles:
+        """
+        Candles of figi in [from_, to). Only the part that is not stored yet is fetched.
+        Concurrent callers wait for the running update and reuse its candles
+        """
+        async with self._key_lock.lock(f"{interval.name}_{figi}"):
+            return await self._get_candles(figi, interval, from_, to, fetch)
+
+    async def _get_candles(
+        self,
+        figi: str,
+        interval: inv.CandleInterval,
+        from_: datetime.datetime,
+        to: datetime.datetime,
+        fetch: FetchCandles,
+    ) -> Candles:
+        from_ts, to_ts = to_timestamp(from_), to_timestamp(to)
+        stored = self.load(figi, interval)
+        if stored is None:
+            CACHE_REQUESTS.inc(kind="candle_store", result="miss")
+            candles = candles_to_columns(await fetch(figi, from_, to, interval))
+            self.save(figi, interval, candles, from_ts, to_ts)
+            return candles.window(from_ts, to_ts)
+
+        candles, start, end, updated_at = stored
+        parts = [candles]
+        changed = False
+        # Missing head
+        if from_ts < start:
+            head = candles_to_columns(await fetch(figi, from_, datetime.datetime.utcfromtimestamp(start), interval))
+            parts = [head.window(from_ts, start), candles]
+            start = from_ts
+            changed = True
+        # Missing tail together with the last stored candle that could still be forming
+        if to_ts > end and time.time() - updated_at >= self.refresh_interval:
+            tail_from = int(candles.time[-1]) if len(candles) > 0 else end
+            tail = candles_to_columns(await fetch(figi, datetime.datetime.utcfromtimestamp(tail_from), to, interval))
+            parts[-1] = candles.window(start, tail_from)
+            parts.append(tail.window(tail_from, to_ts))
+            end = to_ts
+            changed = True
+        CACHE_REQUESTS.inc(kind="candle_store", result="partial" if changed else "hit")
+        if changed:
+            candles = Candles.concat(parts)
+            self.save(figi, interval, candles, start, end)
+        return candles.window(from_ts, to_ts)
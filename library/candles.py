@@ -0,0 +1,155 @@
+import dataclasses
+import datetime
+
+import numpy as np
+import tinkoff.invest as inv
+
+
+###################################################################################
+# Time
+###################################################################################
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def to_timestamp(time: datetime.datetime) -> int:
+    """
+    Epoch seconds of datetime. Naive datetimes are treated as UTC (as datetime.utcnow() returns)
+    """
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return int(time.timestamp())
+
+
+def from_timestamp(timestamp: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(int(timestamp), tz=datetime.timezone.utc)
+
+
+def get_epoch_day(time: datetime.datetime | None = None) -> int:
+    """
+    Epoch day of time (UTC now by default)
+    """
+    if time is None:
+        time = datetime.datetime.utcnow()
+    return to_timestamp(time) // SECONDS_PER_DAY
+
+
+###################################################################################
+# Intervals
+###################################################################################
+
+
+# Longest horizon (days) of the interval, longer horizons use monthly candles
+HORIZON_INTERVALS: list[tuple[int, inv.CandleInterval]] = [
+    (2 * 365, inv.CandleInterval.CANDLE_INTERVAL_DAY),
+    (5 * 365, inv.CandleInterval.CANDLE_INTERVAL_WEEK),
+]
+
+# Maximum number of days covered by one candle of the interval
+INTERVAL_DAYS: dict[inv.CandleInterval, int] = {
+    inv.CandleInterval.CANDLE_INTERVAL_DAY: 1,
+    inv.CandleInterval.CANDLE_INTERVAL_WEEK: 7,
+    inv.CandleInterval.CANDLE_INTERVAL_MONTH: 31,
+}
+
+
+def get_interval(n_days: int) -> inv.CandleInterval:
+    """
+    Candle interval of a horizon, so that long horizons need about as many candles (and requests) as short ones
+    """
+    for max_n_days, interval in HORIZON_INTERVALS:
+        if n_days <= max_n_days:
+            return interval
+    return inv.CandleInterval.CANDLE_INTERVAL_MONTH
+
+
+###################################################################################
+# Columnar candles
+###################################################################################
+
+
+@dataclasses.dataclass
+class Candles:
+    """
+    Candles of one instrument as columns sorted by time.
+    time is the candle start in epoch seconds
+    """
+
+    time: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    @classmethod
+    def empty(cls) -> "Candles":
+        return cls(np.empty(0, dtype=np.int64), *[np.empty(0, dtype=np.float64) for _ in range(5)])
+
+    @classmethod
+    def concat(cls, parts: list["Candles"]) -> "Candles":
+        if not parts:
+            return cls.empty()
+        return cls(*[np.concatenate([getattr(part, field.name) for part in parts]) for field in dataclasses.fields(cls)])
+
+    def to_dict(self) -> dict[str, np.ndarray]:
+        return {field.name: getattr(self, field.name) for field in dataclasses.fields(self)}
+
+    def take(self, index) -> "Candles":
+        return Candles(*[getattr(self, field.name)[index] for field in dataclasses.fields(self)])
+
+    def window(self, from_: int, to: int) -> "Candles":
+        """
+        Candles with from_ <= time < to
+        """
+        start, end = np.searchsorted(self.time, [from_, to], side="left")
+        return self.take(slice(start, end))
+
+    def days(self) -> np.ndarray:
+        """
+        Epoch days of candles
+        """
+        return self.time // SECONDS_PER_DAY
+
+    def dates(self) -> np.ndarray:
+        return self.days().astype("datetime64[D]")
+
+
+# Integer fields of a candle in the order they are decoded
+N_CANDLE_FIELDS = 10
+
+
+def candles_to_columns(candles: list[inv.HistoricCandle]) -> Candles:
+    """
+    Decode candles (e.g. GetCandlesResponse.candles) into columns.
+    The candle objects are walked once, prices are built from units/nano arrays
+    """
+    values = np.fromiter(
+        (
+            value
+            for candle in candles
+            for value in (
+                int(candle.time.timestamp()),
+                candle.open.units, candle.open.nano,
+                candle.high.units, candle.high.nano,
+                candle.low.units, candle.low.nano,
+                candle.close.units, candle.close.nano,
+                candle.volume,
+            )
+        ),
+        dtype=np.int64,
+        count=len(candles) * N_CANDLE_FIELDS,
+    ).reshape(-1, N_CANDLE_FIELDS)
+    prices = values[:, 1:9:2] + values[:, 2:9:2] * 1e-9
+    return Candles(
+        time=values[:, 0].copy(),
+        open=prices[:, 0].copy(),
+        high=prices[:, 1].copy(),
+        low=prices[:, 2].copy(),
+        close=prices[:, 3].copy(),
+        volume=values[:, 9].astype(np.float64),
+    )
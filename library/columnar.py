@@ -0,0 +1,67 @@
+import json
+import struct
+import typing as tp
+from pathlib import Path
+
+import numpy as np
+
+from library.files import atomic_write
+
+
+###################################################################################
+# Columnar files
+###################################################################################
+
+
+# File layout: MAGIC, header length (uint64), JSON header, columns aligned to ALIGNMENT bytes
+MAGIC = b"COLUMNS1"
+ALIGNMENT = 64
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_columns(path: Path, columns: dict[str, np.ndarray], meta: dict | None = None) -> None:
+    """
+    Write 1-D columns of fixed-size dtypes (numbers, bools, fixed-width strings) and JSON-able meta into one file
+    """
+    arrays = {name: np.ascontiguousarray(column) for name, column in columns.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        if array.dtype.hasobject:
+            raise ValueError(f"Column {name} has object dtype")
+        offset = _align(offset)
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += array.nbytes
+    header = json.dumps({"meta": meta or {}, "columns": layout}).encode()
+    # Column offsets are relative to the aligned end of the header
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    def write(f: tp.BinaryIO) -> None:
+        f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        for name, array in arrays.items():
+            f.write(b"\0" * (data_start + layout[name]["offset"] - f.tell()))
+            f.write(array.tobytes())
+
+    atomic_write(path, write)
+
+
+def read_columns(path: Path) -> tuple[dict[str, np.ndarray], dict]:
+    """
+    Columns and meta of a file written by write_columns.
+    Columns are read-only views of the memory-mapped file, pages are read when a column is used
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a columnar file")
+        (header_length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length))
+    data_start = _align(len(MAGIC) + 8 + header_length)
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    columns = {
+        name: np.ndarray(tuple(column["shape"]), dtype=np.dtype(column["dtype"]), buffer=buffer, offset=data_start + column["offset"])
+        for name, column in header["columns"].items()
+    }
+    return columns, header["meta"]
@@ -0,0 +1,32 @@
+import numpy as np
+
+
+###################################################################################
+# Downsampling
+###################################################################################
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_points: int) -> np.ndarray:
+    """
+    Indices of n_points points of the series chosen by Largest-Triangle-Three-Buckets.
+    The first and the last points are kept, every bucket in between keeps the point forming
+    the largest triangle with the previously kept point and the average point of the next bucket
+    """
+    n = len(x)
+    if n <= n_points or n_points < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # n_points - 2 buckets over the points between the first and the last one
+    edges = np.linspace(1, n - 1, n_points - 1).astype(np.int64)
+    edges = np.append(edges, n)
+    indices = np.empty(n_points, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    kept = 0
+    for bucket in range(n_points - 2):
+        start, end, next_end = edges[bucket], edges[bucket + 1], edges[bucket + 2]
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        areas = np.abs((x[kept] - next_x) * (y[start:end] - y[kept]) - (x[kept] - x[start:end]) * (next_y - y[kept]))
+        kept = start + int(np.argmax(areas))
+        indices[bucket + 1] = kept
+    return indices
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import typing as tp
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: no locking between processes
+    fcntl = None
+
+
+###################################################################################
+# Atomic writes
+###################################################################################
+
+
+def atomic_write(path: Path, write: tp.Callable[[tp.BinaryIO], None]) -> None:
+    """
+    Write into a temporary file next to path and rename it, so readers never see a half-written file
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+
+
+###################################################################################
+# Single-runner locks
+###################################################################################
+
+
+def try_lock(path: Path) -> tp.BinaryIO | None:
+    """
+    Exclusive lock of path, held while the returned file is open (the OS releases it when the process exits).
+    None if another process holds it. Without fcntl (Windows) the file is returned unlocked
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    f = open(path, "ab")
+    if fcntl is None:
+        return f
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
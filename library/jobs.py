@@ -0,0 +1,151 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+import typing as tp
+import uuid
+
+from library.runtime import BackgroundLoop
+
+
+###################################################################################
+# Job
+###################################################################################
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, key: tp.Hashable, owner: tp.Hashable):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.owner = owner
+        self.status = Job.PENDING
+        self.result = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.finished_at: float | None = None
+        self.future: concurrent.futures.Future | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (Job.DONE, Job.FAILED, Job.CANCELLED)
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "status": self.status, "error": self.error}
+
+
+###################################################################################
+# Job manager
+###################################################################################
+
+
+class JobManager:
+    """
+    Runs coroutines as jobs on the background loop.
+    At most max_running jobs run at once and at most max_jobs are queued or running,
+    identical in-flight jobs (same key) are deduplicated and every job has a deadline
+    """
+
+    def __init__(
+        self,
+        background_loop: BackgroundLoop,
+        max_running: int = 4,
+        max_jobs: int = 64,
+        deadline: float = 120.0,
+        result_ttl: float = 10 * 60,
+    ):
+        self.background_loop = background_loop
+        self.max_running = max_running
+        self.max_jobs = max_jobs
+        self.deadline = deadline
+        self.result_ttl = result_ttl
+        self._jobs: dict[str, Job] = {}
+        self._in_flight: dict[tp.Hashable, Job] = {}
+        # key -> the last successfully finished job
+        self._finished: dict[tp.Hashable, Job] = {}
+        self._semaphore: asyncio.Semaphore | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def n_in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def _purge(self) -> None:
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.is_finished and now - job.finished_at > self.result_ttl:
+                del self._jobs[job_id]
+                if self._finished.get(job.key) is job:
+                    del self._finished[job.key]
+
+    async def _run(self, job: Job, function: tp.Callable[[], tp.Awaitable]):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_running)
+        async with self._semaphore:
+            # The job could be cancelled before it started
+            if job.status != Job.PENDING:
+                raise asyncio.CancelledError()
+            job.status = Job.RUNNING
+            return await asyncio.wait_for(function(), timeout=self.deadline)
+
+    def _finish(self, job: Job, future: concurrent.futures.Future) -> None:
+        with self._lock:
+            if future.cancelled():
+                job.status = Job.CANCELLED
+            elif isinstance(future.exception(), asyncio.TimeoutError):
+                job.status = Job.FAILED
+                job.error = f"Deadline of {self.deadline:.0f}s exceeded"
+            elif future.exception() is not None:
+                job.status = Job.FAILED
+                job.error = repr(future.exception())
+            else:
+                job.status = Job.DONE
+                job.result = future.result()
+                self._finished[job.key] = job
+            job.finished_at = time.time()
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+
+    def submit(
+        self, key: tp.Hashable, owner: tp.Hashable, function: tp.Callable[[], tp.Awaitable], max_result_age: float = 0.0
+    ) -> Job:
+        """
+        Start function() as a job or return the in-flight job with the same key.
+        A job with the same key finished less than max_result_age seconds ago is returned as well
+        """
+        with self._lock:
+            self._purge()
+            if key in self._in_flight:
+                return self._in_flight[key]
+            finished = self._finished.get(key)
+            if finished is not None and time.time() - finished.finished_at < max_result_age:
+                return finished
+            if len(self._in_flight) >= self.max_jobs:
+                raise JobQueueFull(f"Too many jobs: {len(self._in_flight)}")
+            job = Job(key, owner)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+        job.future = self.background_loop.submit(self._run(job, function))
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def get(self, job_id: str, owner: tp.Hashable) -> Job | None:
+        job = self._jobs.get(job_id)
+        if job is None or job.owner != owner:
+            return None
+        return job
+
+    def cancel(self, job_id: str, owner: tp.Hashable) -> Job | None:
+        job = self.get(job_id, owner)
+        if job is not None and job.future is not None:
+            job.future.cancel()
+        return job
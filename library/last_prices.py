@@ -0,0 +1,270 @@
+import asyncio
+import threading
+import time
+import typing as tp
+
+import tinkoff.invest as inv
+
+from library.cache import CACHE_TTL
+from library.runtime import ClientPool, connect
+
+
+# Maximum number of instruments in one GetLastPrices request
+LAST_PRICES_CHUNK_SIZE = 1000
+# Seconds a quote of a live figi stays fresh, bounds stale prices if the stream stalls without an error
+LIVE_MAX_AGE = 5 * 60
+# Seconds a watcher stays subscribed without watch or touch, so the subscription does not grow with every account ever viewed
+WATCH_TIMEOUT = 30 * 60
+
+
+###################################################################################
+# Last price table
+###################################################################################
+
+
+class LastPriceTable:
+    """
+    In-memory FIGI -> last price table shared by all requests.
+    Quotes received less than max_age seconds ago are reused instead of requested again,
+    quotes of live figis (confirmed subscriptions of the stream) less than live_max_age seconds ago
+    """
+
+    def __init__(
+        self,
+        max_age: float = CACHE_TTL["last_prices"],
+        chunk_size: int = LAST_PRICES_CHUNK_SIZE,
+        live_max_age: float = LIVE_MAX_AGE,
+    ):
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self.live_max_age = live_max_age
+        # figi -> (last price, time it was received)
+        self._prices: dict[str, tuple[inv.LastPrice, float]] = {}
+        # figis kept current by the market data stream
+        self._live: set[str] = set()
+        self._lock = threading.Lock()
+
+    def set_live(self, figis: set[str]) -> None:
+        with self._lock:
+            self._live = set(figis)
+
+    def add_live(self, figis: tp.Iterable[str]) -> None:
+        with self._lock:
+            self._live.update(figis)
+
+    def remove_live(self, figis: tp.Iterable[str]) -> None:
+        with self._lock:
+            self._live.difference_update(figis)
+
+    def update(self, last_prices: list[inv.LastPrice]) -> None:
+        received_at = time.time()
+        with self._lock:
+            for last_price in last_prices:
+                self._prices[last_price.figi] = (last_price, received_at)
+
+    def get(self, figis: list[str], max_age: float | None = None) -> tuple[dict[str, inv.LastPrice], list[str]]:
+        """
+        Fresh last prices of figis and the list of figis without a fresh quote.
+        max_age=0 requests every quote, live figis included
+        """
+        max_age = self.max_age if max_age is None else max_age
+        now = time.time()
+        found = {}
+        missing = []
+        with self._lock:
+            for figi in figis:
+                entry = self._prices.get(figi)
+                if entry is None or max_age <= 0:
+                    missing.append(figi)
+                    continue
+                age = now - entry[1]
+                if age < max_age or (figi in self._live and age < self.live_max_age):
+                    found[figi] = entry[0]
+                else:
+                    missing.append(figi)
+        return found, missing
+
+    async def load(
+        self, client: inv.clients.AsyncServices, figis: list[str], max_age: float | None = None
+    ) -> dict[str, inv.LastPrice]:
+        """
+        Last prices of figis. Only figis without a fresh quote are requested, in chunks
+        """
+        found, missing = self.get(figis, max_age)
+        if missing:
+            chunks = [missing[i:i + self.chunk_size] for i in range(0, len(missing), self.chunk_size)]
+            responses = await asyncio.gather(*[client.market_data.get_last_prices(figi=chunk) for chunk in chunks])
+            last_prices = [last_price for response in responses for last_price in response.last_prices]
+            self.update(last_prices)
+            found.update({last_price.figi: last_price for last_price in last_prices})
+        return found
+
+
+###################################################################################
+# Last price stream
+###################################################################################
+
+
+# Opens the market data stream: takes the iterator of requests and returns the iterator of responses
+OpenStream = tp.Callable[[tp.AsyncIterator[inv.MarketDataRequest]], tp.AsyncIterator[inv.MarketDataResponse]]
+
+
+def open_market_data_stream(token: str, client_pool: ClientPool | None = None) -> OpenStream:
+    def open_stream(requests: tp.AsyncIterator[inv.MarketDataRequest]) -> tp.AsyncIterator[inv.MarketDataResponse]:
+        async def responses():
+            async with connect(token, client_pool) as client:
+                async for response in client.market_data_stream.market_data_stream(requests):
+                    yield response
+
+        return responses()
+
+    return open_stream
+
+
+class LastPriceStream:
+    """
+    Background subscriber on the market data stream that keeps a LastPriceTable current.
+    Every watcher (e.g. account) has its own set of figis, the subscription follows their union.
+    Watchers not renewed (watch or touch) for watch_timeout are dropped.
+    Figis become live in the table once the broker confirms their subscription.
+    All methods must be called on the event loop of the stream
+    """
+
+    def __init__(self, table: LastPriceTable, reconnect_delay: float = 5.0, watch_timeout: float = WATCH_TIMEOUT):
+        self.table = table
+        self.reconnect_delay = reconnect_delay
+        self.watch_timeout = watch_timeout
+        self._watched: dict[str, set[str]] = {}
+        # Watcher -> monotonic time of its last watch or touch
+        self._renewed_at: dict[str, float] = {}
+        self._subscribed: set[str] = set()
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @staticmethod
+    def _make_request(figis: set[str], action: inv.SubscriptionAction) -> inv.MarketDataRequest:
+        return inv.MarketDataRequest(
+            subscribe_last_price_request=inv.SubscribeLastPriceRequest(
+                subscription_action=action,
+                instruments=[inv.LastPriceInstrument(figi=figi) for figi in sorted(figis)],
+            )
+        )
+
+    def _resubscribe(self) -> None:
+        if self._queue is None:
+            return
+        figis = set().union(*self._watched.values())
+        subscribe = figis - self._subscribed
+        unsubscribe = self._subscribed - figis
+        if subscribe:
+            self._queue.put_nowait(self._make_request(subscribe, inv.SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE))
+        if unsubscribe:
+            self._queue.put_nowait(self._make_request(unsubscribe, inv.SubscriptionAction.SUBSCRIPTION_ACTION_UNSUBSCRIBE))
+        self._subscribed = figis
+        # Subscribed figis become live when the subscription is confirmed
+        self.table.remove_live(unsubscribe)
+
+    def _confirm(self, response: inv.SubscribeLastPriceResponse) -> None:
+        """
+        Mark figis with a successful subscription as live (responses to unsubscriptions are ignored)
+        """
+        confirmed, rejected = set(), set()
+        for subscription in response.last_price_subscriptions:
+            if subscription.figi not in self._subscribed:
+                continue
+            if subscription.subscription_status == inv.SubscriptionStatus.SUBSCRIPTION_STATUS_SUCCESS:
+                confirmed.add(subscription.figi)
+            else:
+                rejected.add(subscription.figi)
+        self.table.add_live(confirmed)
+        if rejected:
+            print(f"Last price subscription rejected for {len(rejected)} figis")
+
+    def _drop_idle(self) -> bool:
+        """
+        Drop watchers not renewed for watch_timeout, returns whether there were any
+        """
+        now = time.monotonic()
+        idle = [key for key, renewed_at in self._renewed_at.items() if now - renewed_at > self.watch_timeout]
+        for key in idle:
+            del self._watched[key]
+            del self._renewed_at[key]
+        return bool(idle)
+
+    def watch(self, key: str, figis: tp.Iterable[str]) -> None:
+        """
+        Replace figis of watcher key and resubscribe if the union changed
+        """
+        self._watched[key] = set(figis)
+        self._renewed_at[key] = time.monotonic()
+        self._drop_idle()
+        self._resubscribe()
+
+    def touch(self, key: str) -> None:
+        """
+        Keep watcher key subscribed with its figis
+        """
+        if key in self._watched:
+            self._renewed_at[key] = time.monotonic()
+
+    def unwatch(self, key: str) -> None:
+        self._watched.pop(key, None)
+        self._renewed_at.pop(key, None)
+        self._resubscribe()
+
+    async def _drop_idle_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.watch_timeout / 4)
+            if self._drop_idle():
+                self._resubscribe()
+
+    @staticmethod
+    async def _requests(queue: asyncio.Queue) -> tp.AsyncIterator[inv.MarketDataRequest]:
+        while True:
+            yield await queue.get()
+
+    async def _run(self, open_stream: OpenStream) -> None:
+        dropper = asyncio.get_running_loop().create_task(self._drop_idle_periodically())
+        try:
+            while True:
+                self._queue = asyncio.Queue()
+                self._subscribed = set()
+                self._resubscribe()
+                try:
+                    async for response in open_stream(self._requests(self._queue)):
+                        if response.last_price is not None:
+                            self.table.update([response.last_price])
+                        if response.subscribe_last_price_response is not None:
+                            self._confirm(response.subscribe_last_price_response)
+                except inv.exceptions.AioUnauthenticatedError as ex:
+                    print(f"Market data stream stopped: {ex}")
+                    return
+                except Exception as ex:
+                    print(f"Market data stream failed: {ex}")
+                finally:
+                    self._queue = None
+                    self.table.set_live(set())
+                await asyncio.sleep(self.reconnect_delay)
+        finally:
+            dropper.cancel()
+
+    def start(self, open_stream: OpenStream) -> asyncio.Task:
+        """
+        Start the subscriber on the running event loop
+        """
+        if not self.is_running:
+            self._task = asyncio.get_running_loop().create_task(self._run(open_stream))
+        return self._task
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
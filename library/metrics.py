@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import bisect
+import contextlib
+import functools
+import inspect
+import threading
+import time
+import typing as tp
+
+if tp.TYPE_CHECKING:
+    import tinkoff.invest as inv
+
+
+###################################################################################
+# Metrics
+###################################################################################
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1.0, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def get(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labels), 0.0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    Value read from function at every scrape
+    """
+
+    def __init__(self, name: str, help: str, function: tp.Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {float(self.function())}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> (count per bucket (the last one is +Inf), sum)
+        self._values: dict[tuple, tuple[list[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = counts, total + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip([*self.buckets, "+Inf"], counts):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the process in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, function: tp.Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, help, function))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+BROKER_REQUESTS = registry.counter("broker_requests_total", "Requests to the broker API", ("method", "code"))
+BROKER_REQUEST_SECONDS = registry.histogram("broker_request_duration_seconds", "Latency of requests to the broker API", ("method",))
+BROKER_RETRIES = registry.counter("broker_retries_total", "Requests retried after RESOURCE_EXHAUSTED", ("method",))
+CACHE_REQUESTS = registry.counter("cache_requests_total", "Cache lookups by result (memory or disk hit, coalesced with a running load, partial, miss)", ("kind", "result"))
+CACHE_BYTES_STORED = registry.counter("cache_bytes_stored_total", "Bytes written to the disk caches", ("kind",))
+STAGE_SECONDS = registry.histogram("stage_duration_seconds", "Duration of the stages of page rendering and screening", ("stage",))
+
+
+###################################################################################
+# Spans
+###################################################################################
+
+
+@contextlib.contextmanager
+def span(stage: str) -> tp.Iterator[None]:
+    """
+    Time the enclosed block (sync or containing awaits) into stage_duration_seconds
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+###################################################################################
+# Instrumented client
+###################################################################################
+
+
+class InstrumentedService:
+    """
+    Proxy of a service of AsyncServices counting and timing its unary requests
+    """
+
+    def __init__(self, name: str, service):
+        self._name = name
+        self._service = service
+
+    def __getattr__(self, name: str):
+        # Already imported by the client of the service
+        import tinkoff.invest as inv
+
+        attribute = getattr(self._service, name)
+        if not inspect.iscoroutinefunction(attribute):
+            # Streams are passed through
+            return attribute
+        method = f"{self._name}.{name}"
+
+        @functools.wraps(attribute)
+        async def function(*args, **kwargs):
+            start = time.perf_counter()
+            code = "OK"
+            try:
+                return await attribute(*args, **kwargs)
+            except inv.exceptions.AioRequestError as ex:
+                code = ex.code.name
+                raise
+            except BaseException as ex:
+                # Cancellations, timeouts and errors of the client are not OK either
+                code = type(ex).__name__
+                raise
+            finally:
+                BROKER_REQUESTS.inc(method=method, code=code)
+                BROKER_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method)
+
+        return function
+
+
+class InstrumentedServices:
+    def __init__(self, services: inv.clients.AsyncServices):
+        self._services = services
+
+    def __getattr__(self, name: str) -> InstrumentedService:
+        return InstrumentedService(name, getattr(self._services, name))
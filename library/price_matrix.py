@@ -0,0 +1,163 @@
+import numpy as np
+import tinkoff.invest as inv
+
+from library.candles import Candles, get_epoch_day
+
+
+###################################################################################
+# Price matrix
+###################################################################################
+
+
+def forward_fill(values: np.ndarray) -> np.ndarray:
+    """
+    Forward fill NaNs of a (day x instrument) matrix along days
+    """
+    index = np.where(np.isnan(values), 0, np.arange(len(values))[:, None])
+    np.maximum.accumulate(index, axis=0, out=index)
+    return np.take_along_axis(values, index, axis=0)
+
+
+class PriceMatrix:
+    """
+    Dense (trading day x instrument) close price matrix on a shared calendar of epoch days.
+    Instruments and days are added incrementally, missing prices are forward filled
+    """
+
+    def __init__(self):
+        self.days = np.empty(0, dtype=np.int64)
+        self.figis: list[str] = []
+        self._columns: dict[str, int] = {}
+        # Close prices with NaN for days without a candle
+        self._raw = np.empty((0, 0), dtype=np.float64)
+        self._filled: np.ndarray | None = None
+
+    @property
+    def prices(self) -> np.ndarray:
+        if self._filled is None:
+            self._filled = forward_fill(self._raw)
+        return self._filled
+
+    def _add_instrument(self, figi: str) -> int:
+        self._columns[figi] = len(self.figis)
+        self.figis.append(figi)
+        self._raw = np.hstack([self._raw, np.full((len(self.days), 1), np.nan)])
+        return self._columns[figi]
+
+    def _add_days(self, days: np.ndarray) -> None:
+        new_days = np.setdiff1d(days, self.days, assume_unique=False)
+        if len(new_days) == 0:
+            return
+        new_rows = np.full((len(new_days), len(self.figis)), np.nan)
+        if len(self.days) == 0 or new_days[0] > self.days[-1]:
+            # Usual case: new days are appended
+            self.days = np.concatenate([self.days, new_days])
+            self._raw = np.vstack([self._raw, new_rows])
+            return
+        calendar = np.union1d(self.days, new_days)
+        raw = np.full((len(calendar), len(self.figis)), np.nan)
+        raw[np.searchsorted(calendar, self.days)] = self._raw
+        self.days = calendar
+        self._raw = raw
+
+    def update(self, figi: str, candles: Candles) -> None:
+        """
+        Put daily close prices of figi into the matrix
+        """
+        days = candles.days()
+        self._add_days(days)
+        column = self._columns[figi] if figi in self._columns else self._add_instrument(figi)
+        self._raw[np.searchsorted(self.days, days), column] = candles.close
+        self._filled = None
+
+    def get(self, figis: list[str], from_day: int, to_day: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Days in [from_day, to_day] and forward filled prices of figis on them
+        """
+        to_day = get_epoch_day() if to_day is None else to_day
+        start = np.searchsorted(self.days, from_day, side="left")
+        end = np.searchsorted(self.days, to_day, side="right")
+        columns = [self._columns[figi] for figi in figis]
+        return self.days[start:end], self.prices[start:end][:, columns]
+
+
+###################################################################################
+# Portfolio analytics
+###################################################################################
+
+
+def get_portfolio_value(prices: np.ndarray, holdings: np.ndarray) -> np.ndarray:
+    """
+    Value on each day. holdings are quantities per instrument or a (day x instrument) matrix
+    """
+    return np.nansum(prices * holdings, axis=1)
+
+
+def get_contributions(prices: np.ndarray, holdings: np.ndarray) -> np.ndarray:
+    """
+    (day x instrument) P&L of each position: yesterday's quantity times today's price change.
+    The first day has no P&L
+    """
+    holdings = np.broadcast_to(holdings, prices.shape)
+    contributions = np.zeros_like(prices)
+    contributions[1:] = np.nan_to_num(holdings[:-1] * np.diff(prices, axis=0))
+    return contributions
+
+
+def get_daily_pnl(prices: np.ndarray, holdings: np.ndarray) -> np.ndarray:
+    return get_contributions(prices, holdings).sum(axis=1)
+
+
+###################################################################################
+# Historical holdings
+###################################################################################
+
+
+BUY_OPERATION_TYPES = {
+    inv.OperationType.OPERATION_TYPE_BUY,
+    inv.OperationType.OPERATION_TYPE_BUY_CARD,
+    inv.OperationType.OPERATION_TYPE_BUY_MARGIN,
+    inv.OperationType.OPERATION_TYPE_DELIVERY_BUY,
+}
+SELL_OPERATION_TYPES = {
+    inv.OperationType.OPERATION_TYPE_SELL,
+    inv.OperationType.OPERATION_TYPE_SELL_CARD,
+    inv.OperationType.OPERATION_TYPE_SELL_MARGIN,
+    inv.OperationType.OPERATION_TYPE_DELIVERY_SELL,
+}
+
+
+def get_trades(figis: list[str], operations: list[inv.Operation]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Buys and sells of figis as arrays (epoch day, column of figi, signed quantity)
+    """
+    columns = {figi: column for column, figi in enumerate(figis)}
+    trade_days, cols, quantities = [], [], []
+    for operation in operations:
+        if operation.figi not in columns:
+            continue
+        if operation.operation_type in BUY_OPERATION_TYPES:
+            sign = 1
+        elif operation.operation_type in SELL_OPERATION_TYPES:
+            sign = -1
+        else:
+            continue
+        trade_days.append(get_epoch_day(operation.date))
+        cols.append(columns[operation.figi])
+        quantities.append(sign * (operation.quantity - operation.quantity_rest))
+    return np.array(trade_days, dtype=np.int64), np.array(cols, dtype=np.int64), np.array(quantities, dtype=np.float64)
+
+
+def replay_holdings(days: np.ndarray, balances: np.ndarray, trades: tuple[np.ndarray, np.ndarray, np.ndarray]) -> np.ndarray:
+    """
+    (day x instrument) quantities held at the end of each day.
+    Trades (see get_trades) after a day are rolled back from the current balances
+    """
+    trade_days, cols, quantities = trades
+    balances = np.asarray(balances, dtype=np.float64)
+    # Trade on day d changes the holdings of day d and later
+    changes = np.zeros((len(days) + 1, len(balances)))
+    np.add.at(changes, (np.searchsorted(days, trade_days, side="left"), cols), quantities)
+    # Holdings of day k exclude trades made after it
+    after = changes.sum(axis=0) - np.cumsum(changes, axis=0)[:-1]
+    return balances - after
@@ -0,0 +1,108 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import pickle
+import threading
+import typing as tp
+
+from cachetools import LRUCache
+
+
+###################################################################################
+# Process pool
+###################################################################################
+
+
+class ProcessPoolFull(Exception):
+    pass
+
+
+def get_call_key(function: tp.Callable, args: tuple) -> str:
+    """
+    Hash of a call, identical inputs give the same key
+    """
+    return hashlib.sha1(pickle.dumps((function.__module__, function.__qualname__, args))).hexdigest()
+
+
+class ProcessPool:
+    """
+    Bounded pool of worker processes for CPU-bound work (figures, analytics), so it does not hold the GIL
+    of the web workers. Functions must be module-level and arguments picklable (arrays, lists, numbers).
+    Results of identical calls are reused, identical calls in flight share one task
+    """
+
+    def __init__(self, max_workers: int | None = None, max_pending: int = 64, deadline: float = 30.0, max_results: int = 256):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self._executor: concurrent.futures.ProcessPoolExecutor | None = None
+        self._results: LRUCache = LRUCache(maxsize=max_results)
+        self._in_flight: dict[str, concurrent.futures.Future] = {}
+        # Callers waiting for each task in flight
+        self._waiters: dict[concurrent.futures.Future, int] = {}
+        # Reentrant: cancelling a task under the lock runs its done callback at once
+        self._lock = threading.RLock()
+
+    @property
+    def executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._executor is None:
+            # Workers are not forked from the threads of the web app and do not import its main module
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context(method))
+        return self._executor
+
+    def _finish(self, key: str, future: concurrent.futures.Future) -> None:
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            if not future.cancelled() and future.exception() is None:
+                self._results[key] = future.result()
+
+    async def run(self, function: tp.Callable, *args, deadline: float | None = None):
+        """
+        Result of function(*args) computed in a worker process.
+        Raises asyncio.TimeoutError after the deadline (a task that has not started is cancelled
+        if no other caller waits for it)
+        """
+        key = get_call_key(function, args)
+        submitted = False
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            future = self._in_flight.get(key)
+            if future is None:
+                if len(self._in_flight) >= self.max_pending:
+                    raise ProcessPoolFull(f"Too many tasks: {len(self._in_flight)}")
+                future = self.executor.submit(function, *args)
+                self._in_flight[key] = future
+                submitted = True
+            self._waiters[future] = self._waiters.get(future, 0) + 1
+        if submitted:
+            # Outside the lock: the callback runs at once if the task is already done
+            future.add_done_callback(lambda future: self._finish(key, future))
+        timed_out = False
+        try:
+            # shield: the task is shared by the callers of the same key
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.deadline if deadline is None else deadline)
+        except asyncio.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            with self._lock:
+                self._waiters[future] -= 1
+                if self._waiters[future] == 0:
+                    del self._waiters[future]
+                    if timed_out:
+                        # No other caller waits for the task
+                        future.cancel()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._results.clear()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
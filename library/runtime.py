@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import contextlib
+import threading
+import time
+import typing as tp
+
+from library.metrics import InstrumentedServices
+
+if tp.TYPE_CHECKING:
+    # Imported with the first connection, the web app starts without the broker stack
+    import tinkoff.invest as inv
+
+
+###################################################################################
+# Background event loop
+###################################################################################
+
+
+class BackgroundLoop:
+    """
+    Long-lived event loop running in a daemon thread.
+    Synchronous code (Flask views) submits coroutines to it instead of calling asyncio.run
+    """
+
+    def __init__(self, name: str = "background-loop"):
+        self.name = name
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_started(self) -> bool:
+        return self._loop is not None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name=self.name, daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def submit(self, coroutine: tp.Coroutine) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: tp.Coroutine, timeout: float | None = None):
+        """
+        Runs coroutine on the loop and waits for its result
+        """
+        future = self.submit(coroutine)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+
+
+###################################################################################
+# Client pool
+###################################################################################
+
+
+class PooledClient:
+    def __init__(self, client: inv.AsyncClient, services: inv.clients.AsyncServices):
+        self.client = client
+        self.services = services
+        self.n_users = 0
+        self.used_at = time.monotonic()
+        self.discarded = False
+
+
+class ClientPool:
+    """
+    Pool of per-token AsyncClient connections living on one event loop.
+    Connections that are not used for idle_timeout seconds are closed.
+    client_factory creates the client of a token (inv.AsyncClient by default, a fake one in benchmarks)
+    """
+
+    def __init__(self, idle_timeout: float = 10 * 60, client_factory: tp.Callable[[str], inv.AsyncClient] | None = None):
+        self.idle_timeout = idle_timeout
+        self.client_factory = client_factory
+        self._clients: dict[str, PooledClient] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    @property
+    def n_clients(self) -> int:
+        return len(self._clients)
+
+    async def _open(self, token: str) -> PooledClient:
+        lock = self._locks.setdefault(token, asyncio.Lock())
+        async with lock:
+            if token not in self._clients:
+                if self.client_factory is None:
+                    import tinkoff.invest as inv
+                    self.client_factory = inv.AsyncClient
+                client = self.client_factory(token)
+                self._clients[token] = PooledClient(client, InstrumentedServices(await client.__aenter__()))
+            return self._clients[token]
+
+    async def _close(self, token: str) -> None:
+        pooled = self._clients.pop(token, None)
+        self._locks.pop(token, None)
+        if pooled is not None:
+            await pooled.client.__aexit__(None, None, None)
+
+    async def evict_idle(self) -> None:
+        now = time.monotonic()
+        for token, pooled in list(self._clients.items()):
+            if pooled.n_users == 0 and now - pooled.used_at > self.idle_timeout:
+                await self._close(token)
+
+    async def discard(self, token: str) -> None:
+        """
+        Close the connection of token as soon as nobody uses it (e.g. the token is invalid)
+        """
+        pooled = self._clients.get(token)
+        if pooled is not None:
+            pooled.discarded = True
+            if pooled.n_users == 0:
+                await self._close(token)
+
+    @contextlib.asynccontextmanager
+    async def client(self, token: str) -> tp.AsyncIterator[inv.clients.AsyncServices]:
+        await self.evict_idle()
+        pooled = await self._open(token)
+        pooled.n_users += 1
+        try:
+            yield pooled.services
+        finally:
+            pooled.n_users -= 1
+            pooled.used_at = time.monotonic()
+            if pooled.discarded and pooled.n_users == 0 and self._clients.get(token) is pooled:
+                await self._close(token)
+
+    async def close(self) -> None:
+        for token in list(self._clients):
+            await self._close(token)
+
+
+def connect(token: str, client_pool: ClientPool | None = None) -> tp.AsyncContextManager[inv.clients.AsyncServices]:
+    """
+    Pooled client of token or a new AsyncClient if there is no pool. Requests are counted in the metrics
+    """
+    if client_pool is not None:
+        return client_pool.client(token)
+    return _connect(token)
+
+
+@contextlib.asynccontextmanager
+async def _connect(token: str) -> tp.AsyncIterator[inv.clients.AsyncServices]:
+    import tinkoff.invest as inv
+
+    async with inv.AsyncClient(token=token) as services:
+        yield InstrumentedServices(services)
@@ -0,0 +1,135 @@
+import functools
+import operator
+import time
+
+import numpy as np
+import pandas as pd
+import tinkoff.invest as inv
+
+from library.candles import SECONDS_PER_DAY, to_timestamp
+
+
+###################################################################################
+# Share universe
+###################################################################################
+
+
+# Column -> function of inv.Share
+SHARE_COLUMNS = {
+    "figi": lambda share: share.figi,
+    "ticker": lambda share: share.ticker,
+    "name": lambda share: share.name,
+    "currency": lambda share: share.currency,
+    "class_code": lambda share: share.class_code,
+    "country_of_risk": lambda share: share.country_of_risk,
+    "sector": lambda share: share.sector,
+    "exchange": lambda share: share.exchange,
+    "share_type": lambda share: share.share_type.name,
+    "lot": lambda share: share.lot,
+    "otc_flag": lambda share: share.otc_flag,
+    "buy_available_flag": lambda share: share.buy_available_flag,
+    "sell_available_flag": lambda share: share.sell_available_flag,
+    "for_qual_investor_flag": lambda share: share.for_qual_investor_flag,
+}
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda column, values: np.isin(column, values),
+    "not in": lambda column, values: ~np.isin(column, values),
+}
+
+
+class ShareUniverse:
+    """
+    Shares as columns (one numpy array per attribute) with an index by figi.
+    Last prices are attached as the price, lot_price and last_price_age_days columns,
+    so a screen is a combination of boolean masks.
+    The share columns are stored in the cache as memory-mapped columns (fixed-width strings, numbers, flags)
+    """
+
+    def __init__(self, columns: dict[str, np.ndarray]):
+        self.columns = columns
+        # column -> value -> rows, built on first use
+        self._indexes: dict[str, dict] = {}
+
+    @classmethod
+    def from_shares(cls, shares: list[inv.Share]) -> "ShareUniverse":
+        return cls.from_columns({name: np.array([function(share) for share in shares]) for name, function in SHARE_COLUMNS.items()})
+
+    @classmethod
+    def from_columns(cls, columns: dict[str, np.ndarray]) -> "ShareUniverse":
+        """
+        Universe of share columns without last prices
+        """
+        n_shares = len(columns["figi"])
+        return cls({
+            **{name: columns[name] for name in SHARE_COLUMNS},
+            "price": np.full(n_shares, np.nan),
+            "lot_price": np.full(n_shares, np.nan),
+            "last_price_time": np.full(n_shares, np.nan),
+        })
+
+    def to_columns(self) -> dict[str, np.ndarray]:
+        return {name: self.columns[name] for name in SHARE_COLUMNS}
+
+    @functools.cached_property
+    def row_by_figi(self) -> dict[str, int]:
+        return {figi: row for row, figi in enumerate(self.columns["figi"].tolist())}
+
+    def get_rows(self, figis: list[str]) -> np.ndarray:
+        return np.array([self.row_by_figi[figi] for figi in figis], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.columns["figi"])
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        if column == "last_price_age_days":
+            return (time.time() - self.columns["last_price_time"]) / SECONDS_PER_DAY
+        return self.columns[column]
+
+    def get_index(self, column: str) -> dict:
+        """
+        Rows of every value of a column
+        """
+        if column not in self._indexes:
+            values, inverse = np.unique(self.columns[column], return_inverse=True)
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.searchsorted(inverse[order], np.arange(len(values) + 1))
+            self._indexes[column] = {value: order[start:end] for value, start, end in zip(values.tolist(), bounds[:-1], bounds[1:])}
+        return self._indexes[column]
+
+    def set_last_prices(self, last_prices_by_figi: dict[str, inv.LastPrice]) -> None:
+        rows = np.array([self.row_by_figi[figi] for figi in last_prices_by_figi if figi in self.row_by_figi], dtype=np.int64)
+        last_prices = [last_price for figi, last_price in last_prices_by_figi.items() if figi in self.row_by_figi]
+        self.columns["price"][rows] = [last_price.price.units + last_price.price.nano / 1e9 for last_price in last_prices]
+        self.columns["last_price_time"][rows] = [to_timestamp(last_price.time) for last_price in last_prices]
+        self.columns["lot_price"] = self.columns["price"] * self.columns["lot"]
+
+    def get_mask(self, column: str, op: str, value) -> np.ndarray:
+        # Equality on a column goes through its index
+        if op == "==" and column in SHARE_COLUMNS:
+            mask = np.zeros(len(self), dtype=bool)
+            mask[self.get_index(column).get(value, [])] = True
+            return mask
+        return OPERATORS[op](self[column], value)
+
+    def screen(self, filters: list[dict]) -> np.ndarray:
+        """
+        Mask of shares passing all filters {column, op, value}
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for share_filter in filters:
+            mask &= self.get_mask(share_filter["column"], share_filter["op"], share_filter["value"])
+        return mask
+
+    def to_frame(self, mask: np.ndarray, columns: list[str], sort_by: list[str] | None = None) -> pd.DataFrame:
+        rows = np.flatnonzero(mask)
+        if sort_by:
+            # np.lexsort sorts by the last key first
+            rows = rows[np.lexsort([self[column][rows] for column in reversed(sort_by)])]
+        return pd.DataFrame({column: self[column][rows] for column in columns})
@@ -1,12 +1,23 @@
-import pickle
+import collections
 import typing as tp
 import yaml
 import datetime
 import asyncio
 from pathlib import Path
 
+import numpy as np
 import tinkoff.invest as inv
 
+from library.cache import MARKET_DATA_SCOPE, TieredCache
+from library.candle_fetcher import CandleFetcher
+from library.candle_store import CandleStore
+from library.candles import Candles, get_epoch_day, get_interval
+from library.last_prices import LastPriceStream, LastPriceTable, open_market_data_stream
+from library.price_matrix import PriceMatrix
+from library.process_pool import ProcessPool
+from library.runtime import ClientPool, connect
+from library.universe import ShareUniverse
+
 
 ###################################################################################
 # Utility
@@ -25,28 +36,39 @@ def get_token_account_id(filename: str = "keys.yaml") -> tuple[str, str]:
     return token, account_id
 
 
-def get_accounts_from_token(token: str) -> list[inv.Account] | None:
+def get_accounts(token: str, client_pool: ClientPool | None = None):
+    async def function() -> list[inv.Account] | None:
+        try:
+            async with connect(token, client_pool) as client:
+                accounts: list[inv.Account] = (await client.users.get_accounts()).accounts
+        except inv.exceptions.AioUnauthenticatedError:
+            if client_pool is not None:
+                await client_pool.discard(token)
+            return None
+        return [account for account in accounts if account.status == inv.AccountStatus.ACCOUNT_STATUS_OPEN and account.type != inv.AccountType.ACCOUNT_TYPE_INVEST_BOX]
+
+    return function
+
+
+async def get_accounts_from_token(token: str, client_pool: ClientPool | None = None, force_update: bool = False) -> list[inv.Account] | None:
     """
-    Get one account with the highest RUB balance from token
+    Open accounts of token (except invest boxes) or None if the token is incorrect.
+    Both are cached for the TTL of "accounts"
     """
-    try:
-        with inv.Client(token=token) as client:
-            accounts: list[inv.Account] = client.users.get_accounts().accounts
-        accounts = [account for account in accounts if account.status == inv.AccountStatus.ACCOUNT_STATUS_OPEN and account.type != inv.AccountType.ACCOUNT_TYPE_INVEST_BOX]
-        return accounts
-    except inv.exceptions.UnauthenticatedError:
-        return None
+    return await load_from_cache('accounts', get_accounts(token, client_pool), force_update, scope=token)
 
 
-def get_previous_close(candles: list[inv.HistoricCandle], n_days: int) -> float | None:
-    today = datetime.datetime.utcnow()
-    last_candle = None
-    for candle in reversed(candles):
-        last_candle = candle
-        if candle.time.date() > today.date() - datetime.timedelta(days=n_days):
-            continue
-        return quotation_to_float(candle.close)
-    return quotation_to_float(last_candle.close) if last_candle is not None else None
+def get_previous_close(candles: Candles, n_days: int, today: int | None = None) -> float | None:
+    """
+    Close of the last candle at least n_days old (the first candle if there is none).
+    today is the current epoch day
+    """
+    if len(candles) == 0:
+        return None
+    if today is None:
+        today = get_epoch_day()
+    index = np.searchsorted(candles.days(), today - n_days, side="right") - 1
+    return float(candles.close[max(index, 0)])
 
 
 ###################################################################################
@@ -54,24 +76,29 @@ def get_previous_close(candles: list[inv.HistoricCandle], n_days: int) -> float
 ###################################################################################
 
 
+cache = TieredCache(columnar={"universe": ShareUniverse})
+candle_store = CandleStore()
+candle_fetcher = CandleFetcher()
+last_price_table = LastPriceTable()
+last_price_stream = LastPriceStream(last_price_table)
+# Price matrix of every candle interval
+price_matrices: dict[inv.CandleInterval, PriceMatrix] = collections.defaultdict(PriceMatrix)
+# Worker processes of figures and analytics
+process_pool = ProcessPool()
+
+
 async def load_from_cache(
-    filename: str, function: tp.Callable[..., tp.Awaitable], force_update: bool
+    kind: str,
+    function: tp.Callable[..., tp.Awaitable],
+    force_update: bool,
+    scope: str = "",
+    params: tuple = (),
 ):
     """
-    Loads function return value from cache
+    Loads function return value from cache.
+    Entries are keyed by (scope, kind, params) and expire after the TTL of their kind
     """
-    directory = Path("cache")
-    directory.mkdir(exist_ok=True)
-    path = directory / (filename + ".pickle")
-    if path.exists() and not force_update:
-        print(f"Load {filename} from cache")
-        with open(path, "rb") as f:
-            return pickle.load(f)
-    print(f"Create {filename}")
-    result = await function()
-    with open(path, "wb") as f:
-        pickle.dump(result, f)
-    return result
+    return await cache.get_or_load(kind, function, scope=scope, params=params, force_update=force_update)
 
 
 ###################################################################################
@@ -79,9 +106,9 @@ async def load_from_cache(
 ###################################################################################
 
 
-def get_shares(client: inv.clients.AsyncServices):
-    async def function() -> inv.SharesResponse:
-        return await client.instruments.shares()
+def get_share_universe(client: inv.clients.AsyncServices):
+    async def function() -> ShareUniverse:
+        return ShareUniverse.from_shares((await client.instruments.shares()).instruments)
 
     return function
 
@@ -93,57 +120,131 @@ def get_positions(client: inv.clients.AsyncServices, account_id: str):
     return function
 
 
-def get_last_prices(client: inv.clients.AsyncServices, shares: list[inv.Share]):
-    async def function() -> inv.GetLastPricesResponse:
-        return await client.market_data.get_last_prices(
-            figi=[share.figi for share in shares]
-        )
+def get_operations(client: inv.clients.AsyncServices, account_id: str, from_: datetime.datetime):
+    async def function() -> list[inv.Operation]:
+        return (await client.operations.get_operations(
+            account_id=account_id,
+            from_=from_,
+            to=datetime.datetime.utcnow(),
+            state=inv.OperationState.OPERATION_STATE_EXECUTED,
+        )).operations
+
+    return function
+
+
+def get_last_prices(client: inv.clients.AsyncServices, figis: list[str], force_update: bool = False):
+    """
+    Last prices of figis from the shared last price table
+    """
+    async def function() -> dict[str, inv.LastPrice]:
+        return await last_price_table.load(client, figis, max_age=0 if force_update else None)
+
+    return function
+
+
+def watch_last_prices(token: str, client_pool: ClientPool, key: str, figis: list[str]) -> None:
+    """
+    Keep last prices of figis current through the market data stream.
+    The stream is started with the first token that asks for it
+    """
+    if not last_price_stream.is_running:
+        last_price_stream.start(open_market_data_stream(token, client_pool))
+    last_price_stream.watch(key, figis)
+
+
+def touch_last_prices(key: str) -> None:
+    """
+    Keep the figis of watcher key subscribed while its live data is shown (called on the event loop of the stream)
+    """
+    last_price_stream.touch(key)
+
+
+def fetch_candles(client: inv.clients.AsyncServices):
+    async def function(
+        figi: str, from_: datetime.datetime, to: datetime.datetime, interval: inv.CandleInterval
+    ) -> list[inv.HistoricCandle]:
+        return await candle_fetcher.fetch(client, figi, from_, to, interval)
 
     return function
 
 
 def get_candles(
-    client: inv.clients.AsyncServices, shares: list[inv.Share], n_days: int
+    client: inv.clients.AsyncServices,
+    figis: list[str],
+    n_days: int,
+    interval: inv.CandleInterval | None = None,
 ):
+    """
+    Candles of the last n_days from the candle store. Only missing candles are requested.
+    The interval is picked from the horizon by default (day, week or month candles)
+    """
+    interval = get_interval(n_days) if interval is None else interval
     to = datetime.datetime.utcnow()
-    start_day = to - datetime.timedelta(days=n_days)
-
-    async def get_candles_for_share(share: inv.Share) -> inv.GetCandlesResponse:
-        from_day = start_day
-        while True:
-            try:
-                return await client.market_data.get_candles(
-                    figi=share.figi,
-                    from_=from_day,
-                    to=to,
-                    interval=inv.CandleInterval.CANDLE_INTERVAL_DAY,
-                )
-                break
-            except inv.exceptions.AioRequestError as ex:
-                # Extract the message from the exception tuple
-                status_code, error_code, metadata = ex.args
-                error_message = metadata.message
-
-                if error_message == 'The maximum request period for the given candle interval has been exceeded':
-                    if from_day == to - datetime.timedelta(days=1):
-                        raise
-                    if from_day >= to - datetime.timedelta(days=365):
-                        from_day = min(from_day + datetime.timedelta(days=30), to - datetime.timedelta(days=1))
-                    else:
-                        from_day = min(from_day + datetime.timedelta(days=30), to - datetime.timedelta(days=365))
-                    continue
-                raise
-
-    async def function():
-        return await asyncio.gather(*[get_candles_for_share(share) for share in shares])
+    from_ = to - datetime.timedelta(days=n_days)
+    fetch = fetch_candles(client)
+
+    async def function() -> list[Candles]:
+        return await asyncio.gather(*[candle_store.get_candles(figi, interval, from_, to, fetch) for figi in figis])
 
     return function
 
 
+###################################################################################
+# Market data warmer
+###################################################################################
+
+
+async def warm_market_data(users: list[tuple[str, str]], n_days: int, client_pool: ClientPool | None = None) -> set[str]:
+    """
+    Fetch positions of every (token, account_id) and refresh the shared market data
+    (shares, last prices and candles of n_days) once for the union of their figis
+    """
+    figis = set()
+    market_data_token = None
+    for token, account_id in users:
+        try:
+            async with connect(token, client_pool) as client:
+                positions: list[inv.PositionsSecurities] = (await load_from_cache('positions', get_positions(client, account_id), False, scope=token, params=(account_id,))).securities
+        except inv.exceptions.AioRequestError as ex:
+            print(f"Skip account {account_id}: {ex}")
+            continue
+        figis.update(pos.figi for pos in positions if pos.instrument_type == 'share')
+        market_data_token = market_data_token or token
+    if market_data_token is None:
+        return figis
+
+    # Market data does not depend on the token, any valid one is used
+    async with connect(market_data_token, client_pool) as client:
+        universe: ShareUniverse = await load_from_cache('universe', get_share_universe(client), False, scope=MARKET_DATA_SCOPE)
+        share_figis = [figi for figi in figis if figi in universe.row_by_figi]
+        await get_last_prices(client, share_figis)()
+        await get_candles(client, share_figis, n_days=n_days)()
+    print(f"Warmed market data of {len(share_figis)} shares for {len(users)} accounts")
+    return figis
+
+
+###################################################################################
+# Holdings
+###################################################################################
+
+
+async def get_holdings(token: str, account_id: str, client_pool: ClientPool | None = None) -> list[tuple[str, float, float]]:
+    """
+    (figi, quantity, last price) of the rub shares held on account_id now, as on the portfolio page
+    """
+    async with connect(token, client_pool) as client:
+        universe: ShareUniverse = await load_from_cache('universe', get_share_universe(client), False, scope=MARKET_DATA_SCOPE)
+        positions: list[inv.PositionsSecurities] = (await get_positions(client, account_id)()).securities
+        currencies = universe["currency"]
+        positions = [pos for pos in positions if pos.instrument_type == 'share' and pos.figi in universe.row_by_figi and currencies[universe.row_by_figi[pos.figi]] == 'rub']
+        last_prices = await get_last_prices(client, [pos.figi for pos in positions])()
+    return [(pos.figi, float(pos.balance), quotation_to_float(last_prices[pos.figi].price)) for pos in positions if pos.figi in last_prices]
+
+
 async def main():
     token, account_id = get_token_account_id("keys.yaml")
     from pprint import pprint
-    pprint(get_accounts_from_token(token))
+    pprint(await get_accounts_from_token(token))
 
 
 if __name__ == "__main__":
@@ -1,54 +1,38 @@
-import datetime
 import asyncio
-import yaml
 import pandas as pd
+import yaml
 import sys
 sys.path.append('.')
 
+from library.metrics import span
 from library.utils import *
 
 
-###################################################################################
-# Sort and filter
-###################################################################################
-
-def get_share_key(last_prices_by_figi: dict[str, inv.LastPrice]):
-    def compare_key(share: inv.Share):
-        return quotation_to_float(last_prices_by_figi[share.figi].price) * share.lot
-
-    return compare_key
-
-
-def filter_share(share: inv.Share, positions_figi: set[str], last_prices_by_figi: dict[str, inv.LastPrice], max_price: float):
-    if share.currency != 'rub':
-        return False
-    if share.otc_flag:
-        return False
-    if not share.buy_available_flag or not share.sell_available_flag:
-        return False
-    if share.for_qual_investor_flag:
-        return False
-    if share.class_code != 'TQBR':
-        return False
-    if share.figi in positions_figi:
-        return False
-    if share.country_of_risk != 'RU':
-        return False
-    last_price = last_prices_by_figi[share.figi]
-    if datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc) - last_price.time > datetime.timedelta(days=7):
-        return False
-    price = quotation_to_float(last_price.price)
-    if share.lot * price > max_price:
-        return False
-    return True
+# Columns of the result and their names
+RESULT_COLUMNS = {'ticker': 'ticker', 'name': 'name', 'lot_price': 'price', 'sector': 'sector', 'share_type': 'share_type', 'exchange': 'exchange'}
 
 
 ###################################################################################
-# Print
+# Screener
 ###################################################################################
 
-def get_share_row(share: inv.Share, last_prices_by_figi: dict[str, inv.LastPrice]) -> list:
-    return [share.ticker, share.name, quotation_to_float(last_prices_by_figi[share.figi].price) * share.lot, share.sector, share.share_type.name, share.exchange]
+async def get_underrepresented_shares(client: inv.clients.AsyncServices, token: str, account_id: str, config: dict, force_update: bool) -> pd.DataFrame:
+    """
+    Shares passing the filters of config that are not in the positions of account_id
+    """
+    with span('screener.shares'):
+        universe: ShareUniverse = await load_from_cache('universe', get_share_universe(client), force_update, scope=MARKET_DATA_SCOPE)
+    # the screener needs last prices of the whole universe
+    with span('screener.last_prices'):
+        last_prices_by_figi = await get_last_prices(client, universe['figi'].tolist(), force_update)()
+    with span('screener.positions'):
+        positions: list[inv.PositionsSecurities] = (await load_from_cache('positions', get_positions(client, account_id), force_update, scope=token, params=(account_id,))).securities
+
+    with span('screener.screen'):
+        universe.set_last_prices(last_prices_by_figi)
+        mask = universe.screen(config['filters'])
+        mask &= ~np.isin(universe['figi'], [position.figi for position in positions])
+        return universe.to_frame(mask, list(RESULT_COLUMNS), sort_by=config.get('sort_by')).rename(columns=RESULT_COLUMNS)
 
 
 ###################################################################################
@@ -61,24 +45,11 @@ async def main(force_update: bool):
 
     with open('underrepresented_shares/config.yaml') as f:
         config = yaml.safe_load(f)
-    max_price = config['max_price']
 
     # Create client
-    async with inv.AsyncClient(token=token) as client:
-        shares: list[inv.Share] = (await load_from_cache('shares', get_shares(client), force_update)).instruments
-        last_prices: list[inv.LastPrice] = (await load_from_cache('last_prices', get_last_prices(client, shares), force_update)).last_prices
-        positions: list[inv.PositionsSecurities] = (await load_from_cache('positions', get_positions(client, account_id), force_update)).securities
-
-    positions_figi = {position.figi for position in positions}
-    last_prices_by_figi = {last_price.figi: last_price for last_price in last_prices}
-
-    shares = [share for share in shares if filter_share(share, positions_figi, last_prices_by_figi, max_price)]
-    shares.sort(key=get_share_key(last_prices_by_figi))
-
-    print(f'Number of shares: {len(shares)}\n')
-    rows = [get_share_row(share, last_prices_by_figi) for share in shares]
-    columns = ['ticker', 'name', 'price', 'sector', 'share_type', 'exchange']
-    df = pd.DataFrame(rows, columns=columns)
+    async with connect(token) as client:
+        df = await get_underrepresented_shares(client, token, account_id, config, force_update)
+    print(f'Number of shares: {len(df)}\n')
     print(df.to_string())
 
     result_directory = Path('result/')
@@ -87,4 +58,4 @@ async def main(force_update: bool):
 
 
 if __name__ == '__main__':
-    asyncio.run(main(force_update=True))
+    asyncio.run(main(force_update=False))
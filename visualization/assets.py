@@ -0,0 +1,33 @@
+import importlib.metadata
+import importlib.util
+from pathlib import Path
+
+from library.files import atomic_write
+
+
+###################################################################################
+# plotly.js
+###################################################################################
+
+
+def get_plotlyjs_filename() -> str:
+    """
+    Versioned name of plotly.js asset, so browsers can cache it forever
+    """
+    return f"plotly-{importlib.metadata.version('plotly')}.min.js"
+
+
+def ensure_plotlyjs(static_folder: str | Path) -> str:
+    """
+    Write plotly.js bundle into static folder (once) and return its filename.
+    The bundle is read from the plotly package data, plotly itself is not imported
+    (importlib.resources.files would import it)
+    """
+    filename = get_plotlyjs_filename()
+    path = Path(static_folder) / filename
+    if not path.exists():
+        package_dir = Path(importlib.util.find_spec("plotly").submodule_search_locations[0])
+        bundle = (package_dir / "package_data" / "plotly.min.js").read_bytes()
+        # Several workers can start at once
+        atomic_write(path, lambda f: f.write(bundle))
+    return filename
@@ -1,161 +1,206 @@
-import asyncio
+import dataclasses
+import math
 import numpy as np
-import pandas as pd
-import plotly.express as px
-import plotly.offline as offline
-from colour import Color
 
+from library.candles import INTERVAL_DAYS
+from library.downsampling import lttb
+from library.metrics import span
+from library.price_matrix import get_contributions, get_portfolio_value, get_trades, replay_holdings
 from library.utils import *
 
 
-def add_color(df):
-    df = df.copy()
-    lower = -2
-    upper = 2
-    bins = np.arange(lower, upper + 0.2, 0.2)
-    colors = list(map(lambda x: x.get_web(), Color("red").range_to(Color("green"), len(bins) - 1)))
-    df["color"] = pd.cut(df["return"], bins=bins, labels=colors, include_lowest=True)
-    df.loc[df["return"] >= upper, "color"] = colors[-1]
-    df.loc[df["return"] <= lower, "color"] = colors[0]
-    assert df["color"].isna().sum() == 0
-    return df
-
-
-def plot_ratios_html(tickers, sectors, returns, positions, outliers_pct: float) -> str:
+def get_return_range(returns, outliers_pct: float) -> float:
+    """
+    Maximum absolute return of the color scale, outliers_pct of returns are out of the scale
+    """
     max_abs_return_value = np.abs([np.quantile(returns, outliers_pct / 2 / 100),
                                    np.quantile(returns, (100 - outliers_pct) / 2 / 100)]).max()
-    max_abs_return_value = round(max_abs_return_value * 2) / 2
-
-    df = pd.DataFrame(
-        {
-            "ticker": tickers,
-            "sector": sectors,
-            "return": returns,
-            "position": positions,
-        }
-    )
-    df = add_color(df)
-
-    df["position"] = df["position"].round()
-    df.sort_values(by=["ticker", "sector"], inplace=True)
-
-    fig = px.treemap(
-        df,
-        path=["sector", "ticker"],
-        # box sizes
-        values="position",
-        # colors
-        color="return",
-        color_continuous_scale=["red", "yellow", "green"],
-        color_continuous_midpoint=0.0,
-        range_color=[-max_abs_return_value, max_abs_return_value],
-        hover_data={"return": ":.4f"},
-    )
-    fig.data[0].customdata = np.column_stack(
-        [df["position"].tolist(), df["return"].tolist()]
-    )
-    fig.data[0].texttemplate = "%{label}<br>Position:\t%{customdata[0]:,} RUB<br>Return:\t%{customdata[1]:.2f}%"
-    fig.update_layout(margin=dict(t=5, l=25, r=25, b=25), autosize=True, height=700)
-
-    # Add a JavaScript function to dynamically set the height and width
-    plot_div = offline.plot(fig, include_plotlyjs=True, output_type='div')
-    responsive_script = """
-    <script>
-        window.addEventListener('resize', function() {{
-            var gd = document.getElementsByClassName('js-plotly-plot')[0];
-            Plotly.relayout(gd, {{width: window.innerWidth, height: window.innerHeight}});
-        }});
-        window.dispatchEvent(new Event('resize'));
-    </script>
-    """
-
-    return plot_div + responsive_script
-
+    return round(max_abs_return_value * 2) / 2
 
-def plot_time_profit_html(tickers: list[str], n_stocks: list[int], close_time: list[datetime.date], close_px: list[float]) -> str:
-# Create pandas Series for n_stocks
-    n_stocks = pd.Series(n_stocks, index=tickers)
 
-    # Create DataFrame for close prices
-    close_px = {ticker: pd.Series(px, index=t) for ticker, t, px in zip(tickers, close_time, close_px)}
-    close_px = pd.DataFrame(close_px).ffill()
-
-    # Calculate portfolio value
-    portfolio_value = close_px.mul(n_stocks).sum(axis=1)
-
-    # Plotting the portfolio value as a line chart
-    fig = px.line(portfolio_value,
-                  x=portfolio_value.index,
-                  y=portfolio_value.values,
-                  title="Portfolio Value Over Time",
-                  labels={'x': 'Date', 'y': 'Portfolio Value'},
-                  markers=True,
-                  template="plotly_white")
-
-    # Update layout to improve appearance
-    fig.update_layout(
-        xaxis_title="Date",
-        yaxis_title="Portfolio Value (RUB)",
-        margin=dict(t=50, l=100, r=100, b=100),
-        height=600
-    )
-
-    # Generate HTML string for the plot
-    plot_div = offline.plot(fig, include_plotlyjs=True, output_type='div')
+def get_return(prev_px: float, curr_px: float) -> float:
+    return (curr_px - prev_px) / prev_px * 100
 
-    return plot_div
 
+@dataclasses.dataclass
+class Portfolio:
+    """
+    Data the portfolio graphs are built from
+    """
 
-def get_return(prev_px: float, curr_px: float) -> float:
-    return (curr_px - prev_px) / prev_px * 100
+    tickers: list[str]
+    sectors: list[str]
+    returns: list[float]
+    positions_rub: np.ndarray
+    # portfolio value history
+    dates: np.ndarray
+    values: np.ndarray
+    # P&L since the first date (price changes of the held quantities, trades excluded) and of each position over the history
+    pnl: np.ndarray
+    contributions: np.ndarray
+    # basis of the live treemap: returns and positions are recomputed from the last prices
+    figis: list[str]
+    quantities: list[float]
+    previous_closes: list[float]
+
+
+# Days of candles loaded in addition to n_days (and one candle of the interval)
+N_ADDITIONAL_DAYS = 10
+# Points of the value chart, longer histories are downsampled
+MAX_VALUE_POINTS = 500
+# Percent of returns out of the treemap color scale
+OUTLIERS_PCT = 10.0
+
+
+def get_value_history(
+    days: np.ndarray, prices: np.ndarray, balances: np.ndarray, trades: tuple[np.ndarray, np.ndarray, np.ndarray], max_points: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Days, portfolio values and cumulative P&L with the holdings of each day, downsampled to max_points,
+    and the P&L of each instrument over the whole history (runs in the process pool)
+    """
+    holdings = replay_holdings(days, balances, trades)
+    values = get_portfolio_value(prices, holdings)
+    contributions = get_contributions(prices, holdings)
+    pnl = np.cumsum(contributions.sum(axis=1))
+    # the shape of long histories is kept with max_points points
+    index = lttb(days, values, max_points)
+    return days[index], values[index], pnl[index], contributions.sum(axis=0)
 
 
-async def visualize_async(token: str, account_id: str, n_days: int) -> str:
+async def load_portfolio_async(token: str, account_id: str, n_days: int, client_pool: ClientPool | None = None) -> Portfolio:
     # Create client
     # force_update = True
     force_update = False
-    N_ADDITIONAL_DAYS = 10
-    OUTLIERS_PCT = 10.0
-    async with inv.AsyncClient(token=token) as client:
-        # load shares
-        shares: list[inv.Share] = (await load_from_cache('shares', get_shares(client), force_update)).instruments
-        # load last prices
-        last_prices: list[inv.LastPrice] = (await load_from_cache('last_prices', get_last_prices(client, shares), force_update)).last_prices
+    async with connect(token, client_pool) as client:
+        # load shares (memory-mapped columns)
+        with span("portfolio.shares"):
+            universe: ShareUniverse = await load_from_cache('universe', get_share_universe(client), force_update, scope=MARKET_DATA_SCOPE)
         # load positions
-        positions: list[inv.PositionsSecurities] = (await load_from_cache('positions', get_positions(client, account_id), force_update)).securities
-
-        # map figi to share and last price
-        shares_by_figi: dict[str, inv.Share] = {share.figi: share for share in shares}
-        last_prices_by_figi = {last_price.figi: quotation_to_float(last_price.price) for last_price in last_prices}
+        with span("portfolio.positions"):
+            positions: list[inv.PositionsSecurities] = (await load_from_cache('positions', get_positions(client, account_id), force_update, scope=token, params=(account_id,))).securities
 
         # filter positions to be shares in rub
-        positions = [pos for pos in positions if pos.instrument_type == 'share' and pos.figi in shares_by_figi and shares_by_figi[pos.figi].currency == 'rub']
-
-        # filter shares presented in positions
-        positions_figi = {pos.figi for pos in positions}
-        shares = [share for share in shares if share.figi in positions_figi]
-
-        # get candles for shares in positions
-        candles: list[list[inv.GetCandlesResponse]] = (await load_from_cache(f'position_candles_{n_days}', get_candles(client, shares, n_days=n_days + N_ADDITIONAL_DAYS), force_update))
-        candles_by_figi = {share.figi: share_candles_response.candles for share, share_candles_response in zip(shares, candles)}
+        currencies = universe["currency"]
+        positions = [pos for pos in positions if pos.instrument_type == 'share' and pos.figi in universe.row_by_figi and currencies[universe.row_by_figi[pos.figi]] == 'rub']
+        figis = [pos.figi for pos in positions]
+
+        # load last prices of shares in positions, the web app keeps them current through the stream
+        if client_pool is not None:
+            watch_last_prices(token, client_pool, account_id, figis)
+        with span("portfolio.last_prices"):
+            last_prices = await get_last_prices(client, figis, force_update)()
+        last_prices_by_figi = {figi: quotation_to_float(last_price.price) for figi, last_price in last_prices.items()}
+
+        # get candles for shares in positions, coarser candles for longer horizons
+        interval = get_interval(n_days)
+        n_history_days = n_days + N_ADDITIONAL_DAYS + INTERVAL_DAYS[interval]
+        with span("portfolio.candles"):
+            candles: list[Candles] = await get_candles(client, figis, n_days=n_history_days, interval=interval)()
+        candles_by_figi = dict(zip(figis, candles))
+
+        # get operations to replay the historical holdings
+        from_ = datetime.datetime.utcnow() - datetime.timedelta(days=n_history_days)
+        with span("portfolio.operations"):
+            operations: list[inv.Operation] = await load_from_cache('operations', get_operations(client, account_id, from_), force_update, scope=token, params=(account_id, from_.date()))
+
+    today = get_epoch_day()
+    with span("portfolio.previous_close"):
+        previous_close_by_figi = {pos.figi: get_previous_close(candles_by_figi[pos.figi], n_days=n_days, today=today) for pos in positions}
+
+    # positions, universe, last_prices_by_figi, candles_by_figi, previous_close_by_figi
+
+    rows = universe.get_rows(figis)
+    tickers = universe["ticker"][rows].tolist()
+    sectors = universe["sector"][rows].tolist()
+    returns = [get_return(previous_close_by_figi[pos.figi], last_prices_by_figi[pos.figi]) for pos in positions]
+    positions_rub = np.array([pos.balance * last_prices_by_figi[pos.figi] for pos in positions])
 
-    previous_close_by_figi = {pos.figi: get_previous_close(candles_by_figi[pos.figi], n_days=n_days) for pos in positions}
+    # portfolio value on the shared calendar with the holdings of each day
+    with span("portfolio.value"):
+        price_matrix = price_matrices[interval]
+        for figi in figis:
+            price_matrix.update(figi, candles_by_figi[figi])
+        days, prices = price_matrix.get(figis, from_day=today - n_history_days, to_day=today)
+        balances = np.array([pos.balance for pos in positions], dtype=np.float64)
+        days, values, pnl, contributions = await process_pool.run(
+            get_value_history, days, prices, balances, get_trades(figis, operations), MAX_VALUE_POINTS
+        )
+
+    return Portfolio(
+        tickers, sectors, returns, positions_rub, days.astype("datetime64[D]"), values, pnl, contributions,
+        figis, [float(pos.balance) for pos in positions], [previous_close_by_figi[figi] for figi in figis],
+    )
 
-    # positions, shares_by_figi, last_prices_by_figi, candles_by_figi, previous_close_by_figi
 
-    tickers = [shares_by_figi[pos.figi].ticker for pos in positions]
-    sectors = [shares_by_figi[pos.figi].sector for pos in positions]
-    returns = [get_return(previous_close_by_figi[pos.figi], last_prices_by_figi[pos.figi]) for pos in positions]
-    positions_rub = np.array([pos.balance * last_prices_by_figi[pos.figi] for pos in positions])
+async def get_portfolio_data_async(token: str, account_id: str, n_days: int, client_pool: ClientPool | None = None) -> dict:
+    """
+    Columnar data of the treemap and the value chart, the browser builds the figures
+    """
+    with span("portfolio"):
+        portfolio = await load_portfolio_async(token, account_id, n_days, client_pool)
+    return {
+        "treemap": {
+            "tickers": portfolio.tickers,
+            "sectors": portfolio.sectors,
+            "returns": np.round(portfolio.returns, 4).tolist(),
+            "positions": np.round(portfolio.positions_rub).tolist(),
+            "return_range": get_return_range(portfolio.returns, OUTLIERS_PCT) if portfolio.returns else 0.0,
+        },
+        "value": {
+            "dates": portfolio.dates.astype(str).tolist(),
+            "values": np.round(portfolio.values, 2).tolist(),
+            "pnl": np.round(portfolio.pnl, 2).tolist(),
+            # P&L of each ticker over the chart
+            "tickers": portfolio.tickers,
+            "contributions": np.round(portfolio.contributions, 2).tolist(),
+        },
+        # kept on the server for the live treemap
+        "live": {
+            "figis": portfolio.figis,
+            "quantities": portfolio.quantities,
+            "previous_closes": portfolio.previous_closes,
+        },
+    }
+
+
+def get_live_treemap(live: dict) -> dict:
+    """
+    Returns and positions of the treemap (rounded as in the page data) with the current last prices of the shared table
+    """
+    last_prices, _ = last_price_table.get(live["figis"], max_age=math.inf)
+    prices = [quotation_to_float(last_prices[figi].price) if figi in last_prices else math.nan for figi in live["figis"]]
+    returns = [get_return(previous_close, price) for previous_close, price in zip(live["previous_closes"], prices)]
+    positions = [quantity * price for quantity, price in zip(live["quantities"], prices)]
+    return {"returns": np.round(returns, 4).tolist(), "positions": np.round(positions).tolist()}
 
-    n_stocks = np.array([pos.balance for pos in positions])
-    close_time = [np.array([candle.time.date() for candle in candles_by_figi[pos.figi]]) for pos in positions]
-    close_px = [np.array([quotation_to_float(candle.close) for candle in candles_by_figi[pos.figi]]) for pos in positions]
 
-    ratios_graph = plot_ratios_html(tickers, sectors, returns, positions_rub, outliers_pct=OUTLIERS_PCT)
-    time_profit_graph = plot_time_profit_html(tickers, n_stocks, close_time, close_px)
-    return ratios_graph, time_profit_graph
+def get_current_treemap(treemap: dict, live: dict) -> dict:
+    """
+    Treemap of the page data with the returns and positions of the current last prices
+    (instruments without a price keep the ones of the page data)
+    """
+    current = {**treemap, "returns": list(treemap["returns"]), "positions": list(treemap["positions"])}
+    changes = get_treemap_changes(treemap, get_live_treemap(live))
+    if changes is not None:
+        for i, return_, position in zip(changes["indices"], changes["returns"], changes["positions"]):
+            current["returns"][i] = return_
+            current["positions"][i] = position
+    return current
 
 
-def visualize(token: str, account_id: str, n_days: int) -> str:
-    return asyncio.run(visualize_async(token, account_id, n_days))
+def get_treemap_changes(previous: dict, current: dict) -> dict | None:
+    """
+    Indices, returns and positions of the tickers that changed, None if none did (instruments without a price are skipped)
+    """
+    indices = [
+        i for i, (return_, position) in enumerate(zip(current["returns"], current["positions"]))
+        if not math.isnan(position) and (return_ != previous["returns"][i] or position != previous["positions"][i])
+    ]
+    if not indices:
+        return None
+    return {
+        "indices": indices,
+        "returns": [current["returns"][i] for i in indices],
+        "positions": [current["positions"][i] for i in indices],
+    }
@@ -1,27 +1,71 @@
+import atexit
+import os
+import sys
+import threading
+import time
+import typing as tp
+from pathlib import Path
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from os import path
 from flask_login import LoginManager
+from sqlalchemy import event
+from library import files
+from library.jobs import JobManager
+from library.metrics import registry
+from library.runtime import BackgroundLoop, ClientPool
 
 db = SQLAlchemy()
 DB_NAME = "database.db"
+# Event loop and broker connections shared by all requests
+background_loop = BackgroundLoop()
+client_pool = ClientPool()
+job_manager = JobManager(background_loop)
+# Seconds between attempts of a process to take over a periodic job, if another process runs it
+PERIODIC_LOCK_RETRY = 60
 
+registry.gauge('jobs_in_flight', 'Pending and running portfolio jobs', lambda: job_manager.n_in_flight)
+registry.gauge('broker_clients', 'Open broker connections of the client pool', lambda: client_pool.n_clients)
 
-def create_app():
-    app = Flask(__name__)
+
+class App(Flask):
+    def get_send_file_max_age(self, filename: str | None) -> int | None:
+        # plotly.js is versioned by name, so it can be cached for a long time
+        if filename is not None and filename.startswith('plotly-'):
+            return 365 * 24 * 60 * 60
+        return super().get_send_file_max_age(filename)
+
+
+def create_app(instance_path: str | None = None):
+    # The database is in the instance folder (next to the package by default)
+    app = App(__name__, instance_path=instance_path)
     app.config['SECRET_KEY'] = 'some secret key'
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_NAME}'
+    # Connections are reused by the requests of all threads, writers wait for the lock instead of failing
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 10, 'max_overflow': 10, 'connect_args': {'timeout': 15}}
+    # Seconds between refreshes of the shared market data of all users (disabled if not set)
+    app.config['CACHE_WARM_INTERVAL'] = os.environ.get('CACHE_WARM_INTERVAL')
+    # Seconds between snapshots of the holdings of all users (disabled if not set), the last one of a day is kept
+    app.config['SNAPSHOT_INTERVAL'] = os.environ.get('SNAPSHOT_INTERVAL')
+    # Live treemap streams open at once in a process. A stream holds a worker thread while it is open,
+    # so this must stay well below the threads of a worker; other pages poll the live treemap instead
+    app.config['LIVE_MAX_STREAMS'] = int(os.environ.get('LIVE_MAX_STREAMS', 4))
+    app.extensions['live_streams'] = threading.BoundedSemaphore(app.config['LIVE_MAX_STREAMS'])
     db.init_app(app)
 
+    from visualization.assets import ensure_plotlyjs
+    app.jinja_env.globals['plotlyjs_filename'] = ensure_plotlyjs(app.static_folder)
+
     from .views import views
     from .auth import auth
 
     app.register_blueprint(views, url_prefix='/')
     app.register_blueprint(auth, url_prefix='/')
 
-    from .models import User
+    from .models import User, Snapshot
 
     with app.app_context():
+        event.listen(db.engine, 'connect', set_sqlite_pragmas)
         db.create_all()
 
     login_manager = LoginManager()
@@ -30,11 +74,71 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id))
+        # Identity map of the session: the views reuse this row through current_user
+        return db.session.get(User, int(id))
+
+    from .warmer import init_warmer
+    init_warmer(app)
+
+    from .snapshots import init_snapshots
+    init_snapshots(app)
+
+    atexit.register(shutdown_runtime)
 
     return app
 
 
+def set_sqlite_pragmas(connection, connection_record):
+    """
+    WAL: readers do not block the writer and the writer does not block readers
+    """
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def start_periodic_job(app: Flask, name: str, create_coroutine: tp.Callable[[], tp.Coroutine]) -> None:
+    """
+    Run the coroutine of a periodic job in the background loop of a single process of app.
+    It starts on a request (CLI commands serve none) of the process holding the lock <name>.lock of the instance folder,
+    the others retry, so the job moves on if that process exits. Without fcntl (Windows) every process runs it
+    """
+    guard = threading.Lock()
+    state = {'started': False, 'next_attempt': 0.0}
+
+    @app.before_request
+    def start_job():
+        if state['started'] or time.time() < state['next_attempt']:
+            return
+        with guard:
+            if state['started'] or time.time() < state['next_attempt']:
+                return
+            lock = files.try_lock(Path(app.instance_path) / f'{name}.lock')
+            if lock is None:
+                state['next_attempt'] = time.time() + PERIODIC_LOCK_RETRY
+                return
+            # The lock is held while the process lives
+            state['started'] = True
+            state['lock'] = lock
+        if files.fcntl is None:
+            print(f"Warning: no locks between processes, every process of the app runs {name}")
+        print(f"Start {name} in process {os.getpid()}")
+        background_loop.submit(create_coroutine())
+
+
+def shutdown_runtime():
+    # The analytics stack has nothing to stop if it was never imported
+    utils = sys.modules.get('library.utils')
+    if background_loop.is_started:
+        if utils is not None:
+            background_loop.run(utils.last_price_stream.stop(), timeout=5)
+        background_loop.run(client_pool.close(), timeout=5)
+    background_loop.stop()
+    if utils is not None:
+        utils.process_pool.shutdown()
+
+
 def create_database(app):
     db.create_all(app=app)
     print('Created Database!')
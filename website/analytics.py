@@ -0,0 +1,28 @@
+import importlib
+
+# Thin facade of the analytics and broker stacks (numpy, pandas, plotly, tinkoff.invest).
+# A module is imported on the first use of one of its names (analytics.name, not `from .analytics import name`),
+# so workers start and pages without portfolio data are served without them
+
+# Name -> module it is defined in
+_NAMES = {
+    'get_accounts_from_token': 'library.utils',
+    'get_holdings': 'library.utils',
+    'warm_market_data': 'library.utils',
+    'touch_last_prices': 'library.utils',
+    'get_portfolio_data_async': 'visualization.visualize',
+    'get_live_treemap': 'visualization.visualize',
+    'get_current_treemap': 'visualization.visualize',
+    'get_treemap_changes': 'visualization.visualize',
+    'MAX_VALUE_POINTS': 'visualization.visualize',
+    'lttb': 'library.downsampling',
+}
+
+
+def __getattr__(name: str):
+    if name not in _NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_NAMES[name]), name)
+    # The next lookups do not go through __getattr__
+    globals()[name] = value
+    return value
@@ -10,3 +10,22 @@ class User(db.Model, UserMixin):
     first_name = db.Column(db.String(150))
     token = db.Column(db.String(150), default='')
     account_id = db.Column(db.String(150), default='')
+
+
+class Snapshot(db.Model):
+    """
+    Holding of one instrument on an account at the end of a day, written by the snapshot job
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    account_id = db.Column(db.String(150), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    figi = db.Column(db.String(150), nullable=False)
+    quantity = db.Column(db.Float, nullable=False)
+    close = db.Column(db.Float, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        # The value chart is a range scan of (user_id, account_id) by date
+        db.UniqueConstraint('user_id', 'account_id', 'date', 'figi'),
+    )
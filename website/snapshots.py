@@ -0,0 +1,108 @@
+import asyncio
+import datetime
+
+from flask import Flask
+from sqlalchemy.sql import func
+
+from . import analytics, db, background_loop, client_pool, start_periodic_job
+from .models import Snapshot, User
+
+
+# Days without a snapshot (e.g. the app was down) the value chart tolerates, longer gaps fall back to the candles
+MAX_SNAPSHOT_GAP = 3
+
+
+def get_today() -> datetime.date:
+    # Dates of snapshots are UTC, as epoch days of candles
+    return datetime.datetime.utcnow().date()
+
+
+def get_accounts(app: Flask) -> list[tuple[int, str, str]]:
+    with app.app_context():
+        users = User.query.filter(User.token != '', User.account_id != '').all()
+        return [(user.id, user.token, user.account_id) for user in users]
+
+
+def save_snapshot(app: Flask, user_id: int, account_id: str, date: datetime.date, holdings: list[tuple[str, float, float]]) -> None:
+    """
+    Replace the snapshot of the account on date, the last one of a day holds its closes
+    """
+    with app.app_context():
+        Snapshot.query.filter_by(user_id=user_id, account_id=account_id, date=date).delete()
+        db.session.add_all([
+            Snapshot(user_id=user_id, account_id=account_id, date=date, figi=figi, quantity=quantity, close=close, value=quantity * close)
+            for figi, quantity, close in holdings
+        ])
+        db.session.commit()
+
+
+async def take_snapshots(app: Flask) -> int:
+    """
+    Snapshot today's holdings of all users with a token and account, returns the number of accounts.
+    The database work runs in threads instead of the shared loop
+    """
+    date = get_today()
+    n_accounts = 0
+    for user_id, token, account_id in await asyncio.to_thread(get_accounts, app):
+        try:
+            holdings = await analytics.get_holdings(token, account_id, client_pool)
+        except Exception as ex:
+            print(f"Skip snapshot of account {account_id}: {ex}")
+            continue
+        await asyncio.to_thread(save_snapshot, app, user_id, account_id, date, holdings)
+        n_accounts += 1
+    print(f"Saved snapshots of {n_accounts} accounts on {date}")
+    return n_accounts
+
+
+async def take_snapshots_periodically(app: Flask, interval: float) -> None:
+    while True:
+        try:
+            await take_snapshots(app)
+        except Exception as ex:
+            print(f"Snapshots failed: {ex}")
+        await asyncio.sleep(interval)
+
+
+def get_snapshot_values(user_id: int, account_id: str, n_days: int) -> dict | None:
+    """
+    Value chart of the last n_days (as in get_portfolio_data_async) from the snapshots,
+    None if they do not cover n_days: reach back n_days, end today or yesterday and have no gap over MAX_SNAPSHOT_GAP days
+    """
+    from_date = get_today() - datetime.timedelta(days=n_days)
+    account = (Snapshot.user_id == user_id, Snapshot.account_id == account_id)
+    first_date = db.session.query(func.min(Snapshot.date)).filter(*account).scalar()
+    if first_date is None or first_date > from_date:
+        return None
+    rows = (
+        db.session.query(Snapshot.date, func.sum(Snapshot.value))
+        .filter(*account, Snapshot.date >= from_date)
+        .group_by(Snapshot.date)
+        .order_by(Snapshot.date)
+        .all()
+    )
+    dates = [date for date, _ in rows]
+    values = [value for _, value in rows]
+    if not dates or (get_today() - dates[-1]).days > 1:
+        return None
+    if any((date - previous).days > MAX_SNAPSHOT_GAP for previous, date in zip([from_date, *dates], dates)):
+        return None
+    index = analytics.lttb([date.toordinal() for date in dates], values, analytics.MAX_VALUE_POINTS)
+    return {
+        "dates": [dates[i].isoformat() for i in index],
+        "values": [round(values[i], 2) for i in index],
+    }
+
+
+def init_snapshots(app: Flask) -> None:
+    """
+    Register `flask take-snapshots` and, if SNAPSHOT_INTERVAL (seconds) is set, run the periodic job in one process of the app
+    """
+    @app.cli.command('take-snapshots')
+    def take_snapshots_command():
+        """Snapshot today's holdings of all users with a token and account."""
+        background_loop.run(take_snapshots(app))
+
+    interval = app.config.get('SNAPSHOT_INTERVAL')
+    if interval:
+        start_periodic_job(app, 'snapshots', lambda: take_snapshots_periodically(app, float(interval)))
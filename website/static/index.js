@@ -0,0 +1,231 @@
+// Visualization page: the portfolio data is requested from the JSON API and plotted in the browser
+
+const POLL_INTERVAL_MS = 500;
+// Polling of the live treemap if the server has no free live stream
+const LIVE_POLL_INTERVAL_MS = 10000;
+// Value charts with more points are drawn without markers
+const MAX_MARKER_POINTS = 100;
+
+// Increased on every request of new data, so stale polls stop
+let requestNumber = 0;
+let currentJobUrl = null;
+// Server-sent treemap and its changes, applied to the treemap shown
+let liveSource = null;
+let liveTreemap = null;
+let livePollTimer = null;
+
+function showState(status, error) {
+  document.getElementById("visualization-status").textContent = status;
+  document.getElementById("visualization-error").textContent = error || "";
+}
+
+// Returns the data or null if a newer request was made
+async function fetchPortfolioData(form, url, nDays, number) {
+  while (number === requestNumber) {
+    const response = await fetch(`${url}?n_days=${nDays}`);
+    const data = await response.json();
+    if (response.status === 200) {
+      currentJobUrl = null;
+      return data;
+    }
+    if (response.status !== 202) {
+      throw new Error(data.error || `Request failed with status ${response.status}`);
+    }
+    // The data is being computed by a job
+    currentJobUrl = form.dataset.jobsUrl + data.id;
+    showState(`Job status: ${data.status}`);
+    await new Promise((resolve) => setTimeout(resolve, POLL_INTERVAL_MS));
+  }
+  return null;
+}
+
+// Values, custom data and colors of the treemap nodes: sectors first, then tickers
+function getTreemapNodes(data) {
+  // Sectors are the parents of tickers
+  const sectors = [...new Set(data.sectors)];
+  const sumBySector = (values) =>
+    sectors.map((sector) => values.reduce((sum, value, i) => (data.sectors[i] === sector ? sum + value : sum), 0));
+  const sectorPositions = sumBySector(data.positions);
+  // Return of a sector is weighted by positions as in plotly.express
+  const sectorReturns = sumBySector(data.returns.map((value, i) => value * data.positions[i])).map(
+    (value, i) => (sectorPositions[i] !== 0 ? value / sectorPositions[i] : 0)
+  );
+  return {
+    sectors,
+    values: [...sectorPositions, ...data.positions],
+    customdata: [
+      ...sectorPositions.map((position, i) => [position, sectorReturns[i]]),
+      ...data.positions.map((position, i) => [position, data.returns[i]]),
+    ],
+    colors: [...sectorReturns, ...data.returns],
+  };
+}
+
+function plotTreemap(data) {
+  const nodes = getTreemapNodes(data);
+  const trace = {
+    type: "treemap",
+    ids: [...nodes.sectors, ...data.tickers.map((ticker, i) => `${data.sectors[i]}/${ticker}`)],
+    labels: [...nodes.sectors, ...data.tickers],
+    parents: [...nodes.sectors.map(() => ""), ...data.sectors],
+    values: nodes.values,
+    branchvalues: "total",
+    customdata: nodes.customdata,
+    marker: {
+      colors: nodes.colors,
+      colorscale: [[0, "red"], [0.5, "yellow"], [1, "green"]],
+      cmid: 0,
+      cmin: -data.return_range,
+      cmax: data.return_range,
+      showscale: true,
+    },
+    texttemplate: "%{label}<br>Position:\t%{customdata[0]:,} RUB<br>Return:\t%{customdata[1]:.2f}%",
+    hovertemplate: "%{label}<br>Position: %{customdata[0]:,} RUB<br>Return: %{customdata[1]:.4f}%<extra></extra>",
+  };
+  const layout = { margin: { t: 5, l: 25, r: 25, b: 25 }, autosize: true, height: 700 };
+  Plotly.react("ratios-graph", [trace], layout, { responsive: true });
+}
+
+// Changed returns and positions of tickers: {indices, returns, positions}
+function applyTreemapChanges(changes) {
+  changes.indices.forEach((index, i) => {
+    liveTreemap.returns[index] = changes.returns[i];
+    liveTreemap.positions[index] = changes.positions[i];
+  });
+  const nodes = getTreemapNodes(liveTreemap);
+  Plotly.restyle("ratios-graph", { values: [nodes.values], customdata: [nodes.customdata], "marker.colors": [nodes.colors] });
+}
+
+function stopLiveUpdates() {
+  if (liveSource !== null) {
+    liveSource.close();
+    liveSource = null;
+  }
+  if (livePollTimer !== null) {
+    clearTimeout(livePollTimer);
+    livePollTimer = null;
+  }
+}
+
+// Replots the whole treemap with the current last prices every LIVE_POLL_INTERVAL_MS
+function pollLiveUpdates(form, nDays) {
+  const timer = setTimeout(async () => {
+    try {
+      const response = await fetch(`${form.dataset.liveUrl}?n_days=${nDays}`);
+      if (livePollTimer === timer && response.status === 200) {
+        liveTreemap = await response.json();
+        plotTreemap(liveTreemap);
+      }
+    } catch (error) {
+      // Retried with the next poll
+    }
+    // Stopped or replaced by the updates of another horizon
+    if (livePollTimer === timer) {
+      pollLiveUpdates(form, nDays);
+    }
+  }, LIVE_POLL_INTERVAL_MS);
+  livePollTimer = timer;
+}
+
+function startLiveUpdates(form, treemap, nDays) {
+  stopLiveUpdates();
+  liveTreemap = treemap;
+  liveSource = new EventSource(`${form.dataset.streamUrl}?n_days=${nDays}`);
+  // Every stream (also after a reconnect) starts with the whole treemap the changes are relative to
+  liveSource.addEventListener("treemap", (event) => {
+    liveTreemap = JSON.parse(event.data);
+    plotTreemap(liveTreemap);
+  });
+  liveSource.onmessage = (event) => applyTreemapChanges(JSON.parse(event.data));
+  liveSource.addEventListener("failed", stopLiveUpdates);
+  // The browser reconnects an ended stream, but not a refused one (all streams of the server are taken)
+  liveSource.onerror = () => {
+    if (liveSource !== null && liveSource.readyState === EventSource.CLOSED) {
+      stopLiveUpdates();
+      pollLiveUpdates(form, nDays);
+    }
+  };
+}
+
+function plotValue(data) {
+  const mode = data.values.length <= MAX_MARKER_POINTS ? "lines+markers" : "lines";
+  const traces = [{ type: "scatter", mode, name: "Value", x: data.dates, y: data.values }];
+  // Value charts recorded from snapshots have no P&L
+  if (data.pnl !== undefined) {
+    traces.push({ type: "scatter", mode, name: "P&L", x: data.dates, y: data.pnl });
+  }
+  const layout = {
+    title: "Portfolio Value Over Time",
+    xaxis: { title: "Date" },
+    yaxis: { title: "Portfolio Value (RUB)" },
+    margin: { t: 50, l: 100, r: 100, b: 100 },
+    height: 600,
+    template: "plotly_white",
+  };
+  Plotly.react("time-profit-graph", traces, layout, { responsive: true });
+}
+
+// P&L of each ticker over the value chart, largest first
+function plotContributions(data) {
+  if (data.contributions === undefined) {
+    Plotly.purge("contributions-graph");
+    return;
+  }
+  const order = data.tickers.map((_, i) => i).sort((a, b) => data.contributions[b] - data.contributions[a]);
+  const values = order.map((i) => data.contributions[i]);
+  const trace = {
+    type: "bar",
+    x: order.map((i) => data.tickers[i]),
+    y: values,
+    marker: { color: values.map((value) => (value >= 0 ? "green" : "red")) },
+  };
+  const layout = {
+    title: "P&L by Position",
+    yaxis: { title: "P&L (RUB)" },
+    margin: { t: 50, l: 100, r: 100, b: 100 },
+    height: 500,
+    template: "plotly_white",
+  };
+  Plotly.react("contributions-graph", [trace], layout, { responsive: true });
+}
+
+async function loadVisualization(form) {
+  const number = ++requestNumber;
+  stopLiveUpdates();
+  // The job of the previous horizon is not needed anymore
+  if (currentJobUrl !== null) {
+    fetch(currentJobUrl, { method: "DELETE" });
+    currentJobUrl = null;
+  }
+  const nDays = new FormData(form).get("n_days");
+  showState("Loading...");
+  try {
+    // Both parts are computed by one job, so the value is ready as soon as the treemap is
+    const treemap = await fetchPortfolioData(form, form.dataset.treemapUrl, nDays, number);
+    const value = treemap && (await fetchPortfolioData(form, form.dataset.valueUrl, nDays, number));
+    if (value === null) {
+      return;
+    }
+    showState("");
+    plotTreemap(treemap);
+    plotValue(value);
+    plotContributions(value);
+    startLiveUpdates(form, treemap, nDays);
+  } catch (error) {
+    if (number === requestNumber) {
+      showState("", error.message);
+    }
+  }
+}
+
+document.addEventListener("DOMContentLoaded", () => {
+  const form = document.getElementById("visualization-form");
+  if (form === null) {
+    return;
+  }
+  form.addEventListener("submit", (event) => {
+    event.preventDefault();
+    loadVisualization(form);
+  });
+  loadVisualization(form);
+});
@@ -1,11 +1,14 @@
-import traceback
-from library.utils import get_accounts_from_token
-from visualization.visualize import visualize
+import json
+import time
+import typing as tp
 
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from library.jobs import Job, JobQueueFull
+from library.metrics import registry
+
+from flask import Blueprint, Response, current_app, render_template, request, flash, redirect, url_for, jsonify
 from flask_login import login_required, current_user
-from . import db
-from .models import User
+from . import analytics, db, background_loop, client_pool, job_manager
+from .snapshots import get_snapshot_values
 
 views = Blueprint('views', __name__)
 
@@ -13,7 +16,8 @@ views = Blueprint('views', __name__)
 @views.route('/', methods=['GET', 'POST'])
 @login_required
 def home():
-    user = db.session.query(User).filter_by(id=current_user.id).first()
+    # The row loaded by login_manager for this request
+    user = current_user
 
     # User already entered both token and account_id
     if user.token != '' and user.account_id != '':
@@ -24,14 +28,14 @@ def home():
         if user.token == '':
             return render_template("enter_token.html", user=current_user)
         else:
-            print(get_accounts_from_token(user.token))
-            return render_template("enter_account_id.html", user=current_user, accounts=get_accounts_from_token(user.token))
+            accounts = background_loop.run(analytics.get_accounts_from_token(user.token, client_pool))
+            return render_template("enter_account_id.html", user=current_user, accounts=accounts)
 
     # User have just entered token or account_id
     token = request.form.get('token')  # Gets the note from the HTML
     account_id = request.form.get('account_id')
     if token is not None:
-        accounts = get_accounts_from_token(token)
+        accounts = background_loop.run(analytics.get_accounts_from_token(token, client_pool))
         if accounts is None:
             flash('Token is incorrect! (Authentication error)', category='error')
             return render_template("enter_token.html", user=current_user)
@@ -50,18 +54,157 @@ def home():
 @views.route('/visualization', methods=['GET', 'POST'])
 @login_required
 def visualization():
-    user = db.session.query(User).filter_by(id=current_user.id).first()
+    user = current_user
     if user.token == '' or user.account_id == '':
         return redirect(url_for('views.home'))
 
+    # The page requests the data of the graphs and builds them in the browser
     n_days = request.form.get('n_days', default=30, type=int)
+    return render_template("visualization.html", user=current_user, n_days=n_days)
+
+
+# Seconds the portfolio data of a finished job is served without recomputation
+PORTFOLIO_DATA_MAX_AGE = 30
+
+
+# Seconds between pushes of the live treemap
+LIVE_INTERVAL = 2.0
+# Seconds a live stream is open, the browser reconnects when it ends (and polls if all streams are taken)
+LIVE_MAX_AGE = 10 * 60
+
+
+def submit_portfolio_job(n_days: int, max_result_age: float = PORTFOLIO_DATA_MAX_AGE) -> Job:
+    user = current_user
+    token, account_id = user.token, user.account_id
+    return job_manager.submit(
+        key=(user.id, account_id, n_days),
+        owner=user.id,
+        function=lambda: analytics.get_portfolio_data_async(token, account_id, n_days=n_days, client_pool=client_pool),
+        max_result_age=max_result_age,
+    )
+
+
+def portfolio_data_response(get_data: tp.Callable[[dict], dict], max_result_age: float = PORTFOLIO_DATA_MAX_AGE):
+    """
+    Data taken by get_data from the portfolio data (200) or the state of the job computing it (202)
+    """
+    user = current_user
+    if user.token == '' or user.account_id == '':
+        return jsonify(error='Token or account_id is not set'), 400
+
+    n_days = request.args.get('n_days', default=30, type=int)
+    try:
+        job = submit_portfolio_job(n_days, max_result_age=max_result_age)
+    except JobQueueFull as ex:
+        return jsonify(error=str(ex)), 503
+    if job.status == Job.DONE:
+        return jsonify(get_data(job.result))
+    if job.is_finished:
+        return jsonify(job.to_dict()), 500
+    return jsonify(job.to_dict()), 202
+
+
+@views.route('/api/portfolio/treemap')
+@login_required
+def portfolio_treemap():
+    return portfolio_data_response(lambda result: result['treemap'])
+
 
-    ratios_graph = None
-    time_profit_graph = None
-    error_message = None
+@views.route('/api/portfolio/value')
+@login_required
+def portfolio_value():
+    # Recorded snapshots reach back n_days: actual past holdings without recomputation
+    n_days = request.args.get('n_days', default=30, type=int)
+    value = get_snapshot_values(current_user.id, current_user.account_id, n_days)
+    if value is not None:
+        return jsonify(value)
+    return portfolio_data_response(lambda result: result['value'])
+
+
+@views.route('/api/portfolio/live')
+@login_required
+def portfolio_live():
+    """
+    Treemap with the current last prices, polled by pages that got no live stream
+    """
+    account_id = current_user.account_id
+
+    def get_data(result: dict) -> dict:
+        background_loop.loop.call_soon_threadsafe(analytics.touch_last_prices, account_id)
+        return analytics.get_current_treemap(result['treemap'], result['live'])
+
+    # As the stream, the basis of the page data serves the live treemap
+    return portfolio_data_response(get_data, max_result_age=job_manager.result_ttl)
+
+
+@views.route('/api/portfolio/stream')
+@login_required
+def portfolio_stream():
+    """
+    Server-sent events of the treemap with the current last prices: the whole treemap first
+    (the page data could have been recomputed since the page got it), then the returns and positions
+    of the tickers that changed, computed from the last prices against the previous closes
+    """
+    if current_user.token == '' or current_user.account_id == '':
+        return jsonify(error='Token or account_id is not set'), 400
+
+    n_days = request.args.get('n_days', default=30, type=int)
     try:
-        ratios_graph, time_profit_graph = visualize(user.token, user.account_id, n_days=n_days)
-    except Exception as ex:
-        error_message = f"{str(ex)}\n{traceback.format_exc()}"
+        # The page data is not recomputed, its basis (quantities, previous closes) serves the whole stream
+        job = submit_portfolio_job(n_days, max_result_age=job_manager.result_ttl)
+    except JobQueueFull as ex:
+        return jsonify(error=str(ex)), 503
+    # A stream holds a worker thread while it is open, the page polls /api/portfolio/live if all are taken
+    live_streams = current_app.extensions['live_streams']
+    if not live_streams.acquire(blocking=False):
+        return jsonify(error='Too many live streams'), 503
+    account_id = current_user.account_id
+    # The stream does not use the database, its connection goes back to the pool
+    db.session.remove()
+
+    def events():
+        # The page opens the stream after its data is loaded, so the job is usually done
+        deadline = time.time() + job_manager.deadline
+        while not job.is_finished and time.time() < deadline:
+            time.sleep(0.5)
+        if job.status != Job.DONE:
+            yield f"event: failed\ndata: {json.dumps(job.to_dict())}\n\n"
+            return
+        sent = analytics.get_current_treemap(job.result['treemap'], job.result['live'])
+        yield f"event: treemap\ndata: {json.dumps(sent)}\n\n"
+        end = time.time() + LIVE_MAX_AGE
+        while time.time() < end:
+            time.sleep(LIVE_INTERVAL)
+            # The figis of the account stay subscribed while the stream is open
+            background_loop.loop.call_soon_threadsafe(analytics.touch_last_prices, account_id)
+            current = analytics.get_live_treemap(job.result['live'])
+            changes = analytics.get_treemap_changes(sent, current)
+            if changes is None:
+                # Comment line: keeps the connection open and detects closed ones
+                yield ": no changes\n\n"
+            else:
+                yield f"data: {json.dumps(changes)}\n\n"
+                sent = current
+
+    response = Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also when the stream is closed before it started
+    response.call_on_close(live_streams.release)
+    return response
+
+
+@views.route('/visualization/jobs/<job_id>', methods=['GET', 'DELETE'])
+@login_required
+def visualization_job(job_id: str):
+    if request.method == 'DELETE':
+        job = job_manager.cancel(job_id, owner=current_user.id)
+    else:
+        job = job_manager.get(job_id, owner=current_user.id)
+    if job is None:
+        return jsonify(error='Job not found'), 404
+    return jsonify(job.to_dict())
+
 
-    return render_template("visualization.html", user=current_user, ratios_graph=ratios_graph, time_profit_graph=time_profit_graph, n_days=n_days, error_message=error_message)
+@views.route('/metrics')
+def metrics():
+    # Prometheus text format, metrics of this worker process
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
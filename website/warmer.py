@@ -0,0 +1,46 @@
+import asyncio
+
+import click
+from flask import Flask
+
+from . import analytics, background_loop, client_pool, start_periodic_job
+from .models import User
+
+# Horizon (days) of candles kept warm, longer horizons of the page fetch the rest on demand
+WARM_N_DAYS = 365
+
+
+def get_users_with_account(app: Flask) -> list[tuple[str, str]]:
+    with app.app_context():
+        users = User.query.filter(User.token != '', User.account_id != '').all()
+        return [(user.token, user.account_id) for user in users]
+
+
+async def warm(app: Flask, n_days: int) -> None:
+    # The query blocks, it runs in a thread instead of the shared loop
+    users = await asyncio.to_thread(get_users_with_account, app)
+    await analytics.warm_market_data(users, n_days, client_pool)
+
+
+async def warm_periodically(app: Flask, interval: float, n_days: int) -> None:
+    while True:
+        try:
+            await warm(app, n_days)
+        except Exception as ex:
+            print(f"Cache warming failed: {ex}")
+        await asyncio.sleep(interval)
+
+
+def init_warmer(app: Flask) -> None:
+    """
+    Register `flask warm-cache` and, if CACHE_WARM_INTERVAL (seconds) is set, run the periodic warmer in one process of the app
+    """
+    @app.cli.command('warm-cache')
+    @click.option('--n-days', default=WARM_N_DAYS, help='Days of candles to warm')
+    def warm_cache(n_days: int):
+        """Warm shared market data for all users with a token and account."""
+        background_loop.run(warm(app, n_days))
+
+    interval = app.config.get('CACHE_WARM_INTERVAL')
+    if interval:
+        start_periodic_job(app, 'warmer', lambda: warm_periodically(app, float(interval), WARM_N_DAYS))